@@ -0,0 +1,242 @@
+import hashlib
+import json
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address, ip_network
+from time import time
+from database import get_connection
+from scanner import (
+    SCAN_PROFILES, DEFAULT_SCAN_PROFILE, MAX_NMAP_PROCESSES, discover_hosts, sweep_ports, split_network,
+    get_local_network_range
+)
+from scan_jobs import submit_scan
+import metrics
+
+# Each shard of the local range gets a cheap ping sweep, and each host that
+# changed recently gets a port sweep of its own. A check that finds a
+# change brings its target down to MIN_CHECK_INTERVAL and asks for a
+# pipeline scan; every quiet check doubles the interval, up to
+# MAX_CHECK_INTERVAL. Targets that keep changing (a phone joining and
+# leaving the Wi-Fi) back off instead, and pipeline scans are at least
+# MIN_RESCAN_INTERVAL apart, with the changes in between folded into the
+# next one. The full scan in main.py still runs, just rarely.
+ADAPTIVE_SCANNING = os.getenv('ADAPTIVE_SCANNING', '1') == '1'
+MIN_CHECK_INTERVAL = float(os.getenv('ADAPTIVE_MIN_INTERVAL', '300'))
+MAX_CHECK_INTERVAL = float(os.getenv('ADAPTIVE_MAX_INTERVAL', str(6 * 3600)))
+# At most one triggered pipeline scan per this many seconds, so adaptive
+# scanning never does more range-wide work than the hourly full scan did.
+MIN_RESCAN_INTERVAL = float(os.getenv('ADAPTIVE_MIN_RESCAN_INTERVAL', '3600'))
+# A change adds this to a target's flap score and a quiet check takes one
+# off; a changed target is next checked after MIN_CHECK_INTERVAL doubled
+# once per point. A one-off change is forgotten after two quiet checks,
+# while a target that changes on every check, or every other one, backs off.
+FLAP_PENALTY = 2
+# Past this score a changed target is already checked every MAX_CHECK_INTERVAL.
+MAX_FLAPS = max(0, math.ceil(math.log2(MAX_CHECK_INTERVAL / MIN_CHECK_INTERVAL)))
+# How often main.py looks for due checks.
+CHECK_TICK_SECONDS = 60
+# Completed runs whose anomalies set the starting interval of each target.
+CHURN_HISTORY_RUNS = 24
+# Checks take at most half the nmap budget, leaving the rest for full scans.
+MAX_CONCURRENT_CHECKS = max(1, MAX_NMAP_PROCESSES // 2)
+
+# Anomalies per host over the last CHURN_HISTORY_RUNS completed runs.
+RECENT_CHURN = '''
+    SELECT a.host, COUNT(*), MAX(a.run_id)
+    FROM anomalies AS a JOIN scan_runs AS r ON r.id = a.run_id
+    WHERE r.seq > (SELECT MAX(seq) FROM scan_runs) - ?
+    GROUP BY a.host
+'''
+
+check_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CHECKS, thread_name_prefix='scan-check')
+# Targets with a check queued or running, so a slow check isn't queued twice.
+running = set()
+running_lock = threading.Lock()
+network_range = None
+# When the last triggered pipeline scan was queued, and whether a change
+# has been seen since that has to wait for the next one.
+rescan_lock = threading.Lock()
+last_rescan = 0.0
+rescan_pending = False
+
+def churn_interval(changes):
+    """Starting interval for a target with `changes` recent anomalies: each one halves it."""
+    return max(MIN_CHECK_INTERVAL, MAX_CHECK_INTERVAL / 2 ** min(changes, 32))
+
+def shard_of(host, shards):
+    address = ip_address(host)
+    for shard in shards:
+        if address in shard:
+            return str(shard)
+    return None
+
+def sync_targets(network_range):
+    """
+    Adds a target for every shard of network_range and for every host with
+    recent anomalies, and speeds up existing targets that have new ones.
+    """
+    conn = get_connection()
+    shards = split_network(network_range, SCAN_PROFILES[DEFAULT_SCAN_PROFILE]['shard_prefix'])
+    try:
+        shard_networks = [ip_network(shard) for shard in shards]
+    except ValueError:
+        shard_networks = []
+    churn = {shard: [0, 0] for shard in shards}
+    host_churn = {}
+    for host, changes, last_run in conn.execute(RECENT_CHURN, (CHURN_HISTORY_RUNS,)):
+        host_churn[host] = [changes, last_run]
+        shard = shard_of(host, shard_networks) if shard_networks else shards[0]
+        if shard in churn:
+            churn[shard][0] += changes
+            churn[shard][1] = max(churn[shard][1], last_run)
+
+    now = time()
+    known = {target: (interval, next_due, seen_run_id) for target, interval, next_due, seen_run_id in conn.execute(
+        'SELECT target, interval, next_due, seen_run_id FROM schedule_state')}
+    with conn:
+        for kind, targets in (('shard', churn), ('host', host_churn)):
+            for target, (changes, last_run) in targets.items():
+                state = known.get(target)
+                if state is None:
+                    # Checked right away so the first fingerprint is taken promptly.
+                    conn.execute('''
+                        INSERT INTO schedule_state (target, kind, interval, next_due, seen_run_id)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (target, kind, churn_interval(changes), now, last_run))
+                elif last_run > (state[2] or 0):
+                    interval = min(state[0], churn_interval(changes))
+                    conn.execute('''
+                        UPDATE schedule_state SET interval = ?, next_due = MIN(next_due, ?), seen_run_id = ?
+                        WHERE target = ?
+                    ''', (interval, now + interval, last_run, target))
+        # Shards of a range we no longer scan, and hosts that have settled down.
+        stale = [target for target, kind, interval in conn.execute('SELECT target, kind, interval FROM schedule_state')
+                 if (kind == 'shard' and target not in churn)
+                 or (kind == 'host' and target not in host_churn and interval >= MAX_CHECK_INTERVAL)]
+        conn.executemany('DELETE FROM schedule_state WHERE target = ?', [(target,) for target in stale])
+
+def fingerprint(items):
+    return hashlib.sha1(json.dumps(sorted(items)).encode()).hexdigest()
+
+def check_target(target, kind, timing):
+    """Fingerprint of what a cheap check sees: live hosts for a shard, open ports for a host."""
+    if kind == 'shard':
+        return fingerprint(discover_hosts(target, timing))
+    return fingerprint([f"{port}/{state}" for _, port, state, _, _ in sweep_ports([target], timing)])
+
+def record_check(target, new_fingerprint):
+    """Stores a check's result and reschedules the target. Returns True if it saw a change."""
+    conn = get_connection()
+    now = time()
+    with conn:
+        row = conn.execute('SELECT interval, fingerprint, flaps FROM schedule_state WHERE target = ?',
+                           (target,)).fetchone()
+        if row is None:
+            return False
+        interval, old_fingerprint, flaps = row
+        flaps = flaps or 0
+        # The first check only records what is there.
+        changed = old_fingerprint is not None and old_fingerprint != new_fingerprint
+        if changed:
+            interval = min(MAX_CHECK_INTERVAL, MIN_CHECK_INTERVAL * 2 ** flaps)
+            flaps = min(MAX_FLAPS, flaps + FLAP_PENALTY)
+        elif old_fingerprint is not None:
+            interval = min(MAX_CHECK_INTERVAL, interval * 2)
+            flaps = max(0, flaps - 1)
+        conn.execute('''
+            UPDATE schedule_state
+            SET interval = ?, next_due = ?, last_checked = ?, fingerprint = ?,
+                checks = checks + 1, changes = changes + ?, flaps = ?
+            WHERE target = ?
+        ''', (interval, now + interval, now, new_fingerprint, int(changed), flaps, target))
+    return changed
+
+def request_rescan(network_range):
+    """
+    Queues a pipeline scan of network_range, unless one was queued less than
+    MIN_RESCAN_INTERVAL ago; then it is left pending for run_due_checks.
+    Returns True if a scan was queued.
+    """
+    global last_rescan, rescan_pending
+    with rescan_lock:
+        now = time()
+        if now - last_rescan < MIN_RESCAN_INTERVAL:
+            rescan_pending = True
+            metrics.inc('adaptive_rescans_total', result='deferred')
+            return False
+        last_rescan = now
+        rescan_pending = False
+    metrics.inc('adaptive_rescans_total', result='queued')
+    submit_scan(network_range, trigger='adaptive', mode='pipeline')
+    return True
+
+def run_check(target, kind, network_range):
+    timing = SCAN_PROFILES[DEFAULT_SCAN_PROFILE]['timing']
+    try:
+        changed = record_check(target, check_target(target, kind, timing))
+        metrics.inc('adaptive_checks_total', kind=kind, result='changed' if changed else 'quiet')
+        if changed:
+            if request_rescan(network_range):
+                print(f"Adaptive check saw a change in {target}; queued a pipeline scan.")
+            else:
+                print(f"Adaptive check saw a change in {target}; pipeline scan deferred.")
+    except Exception as e:
+        metrics.inc('adaptive_checks_total', kind=kind, result='error')
+        print(f"Error checking {target}: {e}")
+        # Try again after the target's usual interval rather than on every tick.
+        conn = get_connection()
+        with conn:
+            conn.execute('UPDATE schedule_state SET next_due = ? + interval WHERE target = ?', (time(), target))
+    finally:
+        with running_lock:
+            running.discard(target)
+
+def run_due_checks():
+    """Queues the checks that are due, most overdue first, within the check budget. Called every tick."""
+    global network_range
+    try:
+        if network_range is None:
+            network_range = get_local_network_range()
+        sync_targets(network_range)
+        if rescan_pending and time() - last_rescan >= MIN_RESCAN_INTERVAL:
+            print("Queueing the deferred adaptive pipeline scan.")
+            request_rescan(network_range)
+        with running_lock:
+            free = MAX_CONCURRENT_CHECKS - len(running)
+            if free <= 0:
+                return
+            due = get_connection().execute(
+                'SELECT target, kind FROM schedule_state WHERE next_due <= ? ORDER BY next_due LIMIT ?',
+                (time(), free + len(running))).fetchall()
+            due = [(target, kind) for target, kind in due if target not in running][:free]
+            running.update(target for target, _ in due)
+        for target, kind in due:
+            check_executor.submit(run_check, target, kind, network_range)
+    except Exception as e:
+        print(f"Error scheduling adaptive checks: {e}")
+
+def schedule_status():
+    """Every target with its interval and when it is next due, soonest first."""
+    now = time()
+    return [{
+        'target': target,
+        'kind': kind,
+        'interval_seconds': round(interval),
+        'due_in_seconds': max(0, round(next_due - now)),
+        'last_checked': last_checked,
+        'checks': checks,
+        'changes': changes,
+        'flaps': flaps,
+    } for target, kind, interval, next_due, last_checked, checks, changes, flaps in get_connection().execute('''
+        SELECT target, kind, interval, next_due, last_checked, checks, changes, flaps
+        FROM schedule_state ORDER BY next_due
+    ''')]
+
+def schedule_metrics():
+    rows = get_connection().execute('SELECT kind, COUNT(*) FROM schedule_state GROUP BY kind').fetchall()
+    yield ('adaptive_targets', 'gauge', 'Shards and hosts under adaptive checks.',
+           [({'kind': kind}, count) for kind, count in rows])
+
+metrics.collectors.append(schedule_metrics)
@@ -1,29 +1,26 @@
-from database import get_latest_timestamp, get_previous_timestamp, conn
+from collections import namedtuple
+from database import get_latest_run_id
 
-def detect_anomalies():
-    latest = get_latest_timestamp()
-    if not latest:
-        return ["No scans available."]
-    
-    previous = get_previous_timestamp(latest)
-    if not previous:
-        return ["No previous scan to compare."]
-    
-    cursor = conn.cursor()
-    latest_scan = cursor.execute('SELECT host, port FROM scans WHERE timestamp = ?', (latest,)).fetchall()
-    previous_scan = cursor.execute('SELECT host, port FROM scans WHERE timestamp = ?', (previous,)).fetchall()
+# One change flagged for a run against the baseline. port is None for host changes;
+# old/new hold the previous and current service or version for *_changed.
+Change = namedtuple('Change', ['kind', 'host', 'port', 'old', 'new'])
 
-    latest_hosts = {host for host, _ in latest_scan}
-    previous_hosts = {host for host, _ in previous_scan}
-    latest_ports = {(host, port) for host, port in latest_scan}
-    previous_ports = {(host, port) for host, port in previous_scan}
+HOST_APPEARED = 'host_appeared'
+HOST_DISAPPEARED = 'host_disappeared'
+PORT_OPENED = 'port_opened'
+PORT_CLOSED = 'port_closed'
+SERVICE_CHANGED = 'service_changed'
+VERSION_CHANGED = 'version_changed'
 
-    anomalies = []
-    # Detect new hosts
-    for host in latest_hosts - previous_hosts:
-        anomalies.append(f"New host detected: {host}")
-    # Detect new open ports
-    for host, port in latest_ports - previous_ports:
-        anomalies.append(f"New open port {port} on host {host}")
+def detect_anomalies():
+    """
+    Returns the Changes flagged for the most recent completed run against
+    the rolling baseline (see baseline.py). Returns [] if there is no run yet.
+    """
+    # baseline imports Change and the kinds from here.
+    from baseline import update_baseline
+    latest = get_latest_run_id()
+    if not latest:
+        return []
 
-    return anomalies if anomalies else ["No anomalies detected."]
\ No newline at end of file
+    return update_baseline(latest)
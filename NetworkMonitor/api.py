@@ -1,68 +1,234 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import json
+import os
 import sqlite3
-import speech_recognition as sr
-from scanner import scan_network
-from anomaly_detector import detect_anomalies
-from summarizer import summarize_anomalies
-from database import insert_summary, get_latest_summary
+from scan_jobs import submit_scan, get_job, enable_profiling, get_profile
+from database import connect, get_connection
+from dashboard import get_dashboard
+from export import export_chunks
+import metrics
 
 app = FastAPI()
 
-def get_db_connection():
-    conn = sqlite3.connect('network_scans.db')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+# Voice uploads are read into memory in chunks and rejected past the limit.
+MAX_AUDIO_BYTES = int(os.getenv('MAX_AUDIO_BYTES', str(10 * 1024 * 1024)))
+AUDIO_CHUNK_SIZE = 64 * 1024
+# Recognition blocks on decoding and a network round trip, so it runs on
+# its own small pool. Requests beyond the workers plus this many waiting
+# get a 503 instead of piling up.
+VOICE_WORKERS = int(os.getenv('VOICE_WORKERS', '2'))
+VOICE_QUEUE_SIZE = int(os.getenv('VOICE_QUEUE_SIZE', '8'))
+voice_executor = ThreadPoolExecutor(max_workers=VOICE_WORKERS, thread_name_prefix='voice')
+# Only touched from the event loop, so no lock is needed.
+voice_in_flight = 0
+
+def voice_metrics():
+    yield ('voice_commands_in_flight', 'gauge', 'Voice commands being recognized or waiting for a worker.',
+           [({}, voice_in_flight)])
+    yield ('voice_commands_capacity', 'gauge', 'Voice commands accepted at once before new ones get a 503.',
+           [({}, VOICE_WORKERS + VOICE_QUEUE_SIZE)])
+
+metrics.collectors.append(voice_metrics)
+
+def encode_cursor(row):
+    return f"{row['timestamp']}|{row['id']}"
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = cursor.rsplit('|', 1)
+        return timestamp, int(row_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+def build_page_query(table, filters, cursor, limit):
+    """
+    Builds a newest-first keyset query over (timestamp, id).
+    filters maps column names to values; None values are ignored.
+    """
+    where, params = [], []
+    for column, value in filters.items():
+        if value is not None:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if cursor:
+        where.append("(timestamp, id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
+    sql = f"SELECT * FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY timestamp DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return sql, params
+
+def stream_ndjson(sql, params):
+    # StreamingResponse may pull each chunk on a different worker thread,
+    # so this gets its own connection rather than a per-thread pooled one.
+    conn = connect(check_same_thread=False)
     conn.row_factory = sqlite3.Row
-    return conn
+    try:
+        cur = conn.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(STREAM_CHUNK_SIZE)
+            if not rows:
+                break
+            yield ''.join(json.dumps(dict(row)) + '\n' for row in rows)
+    finally:
+        conn.close()
+
+def paginated_response(table, key, filters, cursor, limit, format):
+    """
+    Returns one page as {key: [...], "next_cursor": ...}, or with
+    format=ndjson every matching row (up to limit, if given) streamed one
+    JSON object per line.
+    """
+    if format == 'ndjson':
+        sql, params = build_page_query(table, filters, cursor, limit)
+        return StreamingResponse(stream_ndjson(sql, params), media_type='application/x-ndjson')
+    if format != 'json':
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'ndjson'.")
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    sql, params = build_page_query(table, filters, cursor, limit)
+    cur = get_connection().cursor()
+    cur.row_factory = sqlite3.Row
+    rows = cur.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
+    return {key: [dict(row) for row in rows], "next_cursor": next_cursor}
 
 @app.get('/summaries')
-def get_summaries():
-    conn = get_db_connection()
-    summaries = conn.execute('SELECT * FROM summaries ORDER BY timestamp DESC').fetchall()
-    conn.close()
-    return [dict(row) for row in summaries]
+def get_summaries(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: str = 'json',
+):
+    return paginated_response('summaries', 'summaries', {}, cursor, limit, format)
 
 @app.get('/logs')
-def get_logs():
-    conn = get_db_connection()
-    logs = conn.execute('SELECT * FROM scans ORDER BY timestamp DESC').fetchall()
-    conn.close()
-    return [dict(row) for row in logs]
-
-@app.post('/scan-now')
-def trigger_scan():
-    scan_network()
-    anomalies = detect_anomalies()
-    summary = summarize_anomalies(anomalies)
-    insert_summary(summary)
-    return {"status": "Scan triggered", "summary": summary}
+def get_logs(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    run_id: Optional[int] = None,
+    format: str = 'json',
+):
+    filters = {'host': host, 'port': port, 'run_id': run_id}
+    return paginated_response('scans', 'logs', filters, cursor, limit, format)
 
-@app.post('/voice-command')
-async def voice_command(audio: UploadFile = File(...)):
-    # Save audio temporarily
-    with open("temp_audio.wav", "wb") as f:
-        f.write(await audio.read())
-    
-    # Recognize speech
+@app.get('/export')
+def export_history(first_run: Optional[int] = Query(None, ge=1), last_run: Optional[int] = Query(None, ge=1)):
+    """
+    Completed runs with ids in [first_run, last_run] in the compact format
+    described in export.py, streamed one run at a time. Read it back with
+    export.load_export.
+    """
+    name = f"scans-{first_run or 'first'}-{last_run or 'last'}.nmscan"
+    return StreamingResponse(export_chunks(first_run, last_run), media_type='application/octet-stream',
+                             headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+@app.post('/scan-now', status_code=202)
+def trigger_scan(profile: bool = False):
+    job, created = submit_scan(trigger='api', profile=profile)
+    return {"status": "Scan triggered" if created else "Scan already in progress", "job": job}
+
+@app.get('/jobs/{job_id}')
+def job_progress(job_id: int):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.post('/jobs/{job_id}/profile')
+def profile_job(job_id: int):
+    job = enable_profiling(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No queued or running job with that id.")
+    return job
+
+@app.get('/jobs/{job_id}/profile', response_class=PlainTextResponse)
+def job_profile(job_id: int):
+    """Sampled stacks in collapsed format, for flamegraph.pl or speedscope."""
+    profile = get_profile(job_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Job not found or not profiled.")
+    return profile
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get('/dashboard')
+def dashboard(request: Request):
+    snapshot = get_dashboard()
+    headers = {"ETag": snapshot["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == snapshot["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot["body"], media_type="application/json", headers=headers)
+
+async def read_upload(upload, limit):
+    """Reads an upload into memory in chunks, raising 413 once it passes limit bytes."""
+    buffer = io.BytesIO()
+    while chunk := await upload.read(AUDIO_CHUNK_SIZE):
+        if buffer.tell() + len(chunk) > limit:
+            raise HTTPException(status_code=413, detail=f"Audio upload exceeds {limit} bytes.")
+        buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+def transcribe(recognizer, audio_data):
+    return recognizer.recognize_google(audio_data)
+
+def recognize_command(buffer):
+    """Decodes the audio and returns the lowercased command, or None if no speech was understood."""
+    # Imported on first use; processes that never get a voice command don't pay for it.
+    import speech_recognition as sr
     r = sr.Recognizer()
-    with sr.AudioFile("temp_audio.wav") as source:
+    with sr.AudioFile(buffer) as source:
         audio_data = r.record(source)
-        try:
-            command = r.recognize_google(audio_data)
-            command = command.lower()
-            if "scan now" in command:
-                scan_network()
-                anomalies = detect_anomalies()
-                summary = summarize_anomalies(anomalies)
-                insert_summary(summary)
-                return {"action": "scan", "summary": summary}
-            elif "what's new" in command:
-                summary = get_latest_summary()
-                return {"action": "summary", "summary": summary}
-            else:
-                return {"error": "Command not recognized"}
-        except sr.UnknownValueError:
-            return {"error": "Could not understand audio"}
-        finally:
-            # Clean up
-            import os
-            if os.path.exists("temp_audio.wav"):
-                os.remove("temp_audio.wav")
\ No newline at end of file
+    try:
+        return transcribe(r, audio_data).lower()
+    except sr.UnknownValueError:
+        return None
+
+@app.post('/voice-command')
+async def voice_command(request: Request, audio: UploadFile = File(...)):
+    global voice_in_flight
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > MAX_AUDIO_BYTES + AUDIO_CHUNK_SIZE:
+        raise HTTPException(status_code=413, detail=f"Audio upload exceeds {MAX_AUDIO_BYTES} bytes.")
+    buffer = await read_upload(audio, MAX_AUDIO_BYTES)
+
+    if voice_in_flight >= VOICE_WORKERS + VOICE_QUEUE_SIZE:
+        metrics.inc('voice_commands_rejected_total')
+        raise HTTPException(status_code=503, detail="Too many voice commands in progress.",
+                            headers={"Retry-After": "1"})
+    voice_in_flight += 1
+    try:
+        command = await asyncio.get_running_loop().run_in_executor(voice_executor, recognize_command, buffer)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Audio must be WAV, AIFF or FLAC.")
+    finally:
+        voice_in_flight -= 1
+
+    if command is None:
+        return {"error": "Could not understand audio"}
+    if "scan now" in command:
+        job, created = await asyncio.to_thread(submit_scan, trigger='voice')
+        summary = "Scan started." if created else "A scan is already in progress."
+        return {"action": "scan", "summary": summary, "job": job}
+    elif "what's new" in command:
+        summary = (await asyncio.to_thread(get_dashboard))['summary']
+        return {"action": "summary", "summary": summary}
+    else:
+        return {"error": "Command not recognized"}
@@ -0,0 +1,196 @@
+import hashlib
+import os
+from database import get_connection, get_run_seq, get_run_id_for_seq
+from anomaly_detector import (
+    Change, HOST_APPEARED, HOST_DISAPPEARED, PORT_OPENED, PORT_CLOSED, SERVICE_CHANGED, VERSION_CHANGED
+)
+
+# An entry has to be gone for this many consecutive runs before its
+# disappearance is flagged, or before its return counts as new again.
+# A host that drops out for a run or two and comes back stays quiet.
+BASELINE_WINDOW = int(os.getenv('BASELINE_WINDOW', '3'))
+
+# Ports in the run that the baseline doesn't have as present, or has with
+# a different service/version.
+RUN_VS_BASELINE = '''
+    SELECT cur.host, cur.port, b.host IS NOT NULL, b.present, b.absent_since,
+           b.service, cur.service, b.version, cur.version
+    FROM scans AS cur
+    LEFT JOIN port_baseline AS b ON b.host = cur.host AND b.port = cur.port
+    WHERE cur.run_id = ?
+      AND (b.host IS NULL OR b.present = 0 OR cur.service IS NOT b.service OR cur.version IS NOT b.version)
+'''
+# Ports the baseline has as present that are missing from the run.
+MISSING_FROM_RUN = '''
+    SELECT b.host, b.port, b.present_since
+    FROM port_baseline AS b
+    WHERE b.present = 1
+      AND NOT EXISTS (SELECT 1 FROM scans AS cur
+                      WHERE cur.run_id = ? AND cur.host = b.host AND cur.port = b.port)
+'''
+
+def port_fingerprint(ports):
+    if not ports:
+        return None
+    return hashlib.sha1(','.join(str(port) for port in sorted(ports)).encode()).hexdigest()[:16]
+
+def rebuild_baseline(run_id, seq):
+    """Starts the baseline over from a single run, with nothing flagged."""
+    conn = get_connection()
+    conn.execute('DELETE FROM port_baseline')
+    conn.execute('DELETE FROM host_baseline')
+    conn.execute('''
+        INSERT OR REPLACE INTO port_baseline
+            (host, port, service, version, first_seen, last_seen, present_since, absent_since, seen_runs, present)
+        SELECT host, port, service, version, ?, NULL, ?, NULL, 0, 1 FROM scans WHERE run_id = ?
+    ''', (seq, seq, run_id))
+    ports_by_host = {}
+    for host, port in conn.execute('SELECT host, port FROM port_baseline'):
+        ports_by_host.setdefault(host, []).append(port)
+    conn.executemany('''
+        INSERT INTO host_baseline
+            (host, port_fingerprint, first_seen, last_seen, present_since, absent_since, seen_runs, present)
+        VALUES (?, ?, ?, NULL, ?, NULL, 0, 1)
+    ''', [(host, port_fingerprint(ports), seq, seq) for host, ports in ports_by_host.items()])
+    set_baseline_state(run_id, seq)
+
+def set_baseline_state(run_id, seq):
+    get_connection().execute('INSERT OR REPLACE INTO baseline_state (id, run_id, seq) VALUES (1, ?, ?)', (run_id, seq))
+
+def returned_after_window(seq, absent_since):
+    return seq - absent_since >= BASELINE_WINDOW
+
+def fold_ports(run_id, seq):
+    """Applies the run's port differences to port_baseline. Returns (flagged, touched hosts)."""
+    conn = get_connection()
+    flagged = []
+    touched = set()
+    for host, port, known, present, absent_since, old_service, service, old_version, version in conn.execute(
+            RUN_VS_BASELINE, (run_id,)).fetchall():
+        if not known:
+            flagged.append(Change(PORT_OPENED, host, port, None, None))
+            conn.execute('''
+                INSERT INTO port_baseline
+                    (host, port, service, version, first_seen, last_seen, present_since, absent_since, seen_runs, present)
+                VALUES (?, ?, ?, ?, ?, NULL, ?, NULL, 0, 1)
+            ''', (host, port, service, version, seq, seq))
+            touched.add(host)
+            continue
+        if not present:
+            if returned_after_window(seq, absent_since):
+                flagged.append(Change(PORT_OPENED, host, port, None, None))
+            touched.add(host)
+        elif old_service != service:
+            flagged.append(Change(SERVICE_CHANGED, host, port, old_service, service))
+        else:
+            flagged.append(Change(VERSION_CHANGED, host, port, old_version, version))
+        conn.execute('''
+            UPDATE port_baseline
+            SET service = ?, version = ?, present = 1,
+                present_since = CASE WHEN present = 1 THEN present_since ELSE ? END, absent_since = NULL
+            WHERE host = ? AND port = ?
+        ''', (service, version, seq, host, port))
+
+    for host, port, present_since in conn.execute(MISSING_FROM_RUN, (run_id,)).fetchall():
+        conn.execute('''
+            UPDATE port_baseline
+            SET present = 0, absent_since = ?, last_seen = ?, seen_runs = seen_runs + ?
+            WHERE host = ? AND port = ?
+        ''', (seq, seq - 1, seq - present_since, host, port))
+        touched.add(host)
+    return flagged, touched
+
+def fold_hosts(hosts, seq):
+    """Updates host_baseline for hosts whose ports changed. Returns flagged changes."""
+    conn = get_connection()
+    flagged = []
+    for host in hosts:
+        ports = [port for (port,) in conn.execute(
+            'SELECT port FROM port_baseline WHERE host = ? AND present = 1', (host,))]
+        fingerprint = port_fingerprint(ports)
+        row = conn.execute('SELECT present, present_since, absent_since FROM host_baseline WHERE host = ?',
+                           (host,)).fetchone()
+        if row is None:
+            flagged.append(Change(HOST_APPEARED, host, None, None, None))
+            conn.execute('''
+                INSERT INTO host_baseline
+                    (host, port_fingerprint, first_seen, last_seen, present_since, absent_since, seen_runs, present)
+                VALUES (?, ?, ?, NULL, ?, NULL, 0, 1)
+            ''', (host, fingerprint, seq, seq))
+            continue
+        present, present_since, absent_since = row
+        if ports and not present:
+            if returned_after_window(seq, absent_since):
+                flagged.append(Change(HOST_APPEARED, host, None, None, None))
+            conn.execute('''
+                UPDATE host_baseline SET port_fingerprint = ?, present = 1, present_since = ?, absent_since = NULL
+                WHERE host = ?
+            ''', (fingerprint, seq, host))
+        elif not ports and present:
+            conn.execute('''
+                UPDATE host_baseline
+                SET port_fingerprint = NULL, present = 0, absent_since = ?, last_seen = ?, seen_runs = seen_runs + ?
+                WHERE host = ?
+            ''', (seq, seq - 1, seq - present_since, host))
+        else:
+            conn.execute('UPDATE host_baseline SET port_fingerprint = ? WHERE host = ?', (fingerprint, host))
+    return flagged
+
+def window_expired(seq):
+    """Hosts and ports that have now been gone for exactly BASELINE_WINDOW runs."""
+    conn = get_connection()
+    gone_since = seq - BASELINE_WINDOW + 1
+    flagged = [
+        Change(HOST_DISAPPEARED, host, None, None, None)
+        for (host,) in conn.execute(
+            'SELECT host FROM host_baseline WHERE present = 0 AND absent_since = ?', (gone_since,))
+    ]
+    # Ports of hosts that are gone altogether are covered by the host change.
+    flagged.extend(
+        Change(PORT_CLOSED, host, port, None, None)
+        for host, port in conn.execute('''
+            SELECT b.host, b.port FROM port_baseline AS b
+            JOIN host_baseline AS h ON h.host = b.host AND h.present = 1
+            WHERE b.present = 0 AND b.absent_since = ?
+        ''', (gone_since,))
+    )
+    return flagged
+
+def load_anomalies(run_id):
+    return [Change(*row) for row in get_connection().execute(
+        'SELECT kind, host, port, old, new FROM anomalies WHERE run_id = ? ORDER BY id', (run_id,))]
+
+def update_baseline(run_id):
+    """
+    Folds a completed run into the baseline and returns the Changes it
+    flags. Work is proportional to the differences between the run and
+    the baseline, not to the amount of history. Runs already folded in
+    return their stored anomalies. If the baseline isn't at the previous
+    run (first use, or runs were skipped) it is rebuilt from that run
+    first; a very first run only seeds the baseline.
+    """
+    conn = get_connection()
+    seq = get_run_seq(run_id)
+    if seq is None:
+        return []
+    state = conn.execute('SELECT run_id, seq FROM baseline_state').fetchone()
+    if state is not None and state[1] >= seq:
+        return load_anomalies(run_id)
+
+    with conn:
+        if state is None or state[1] != seq - 1:
+            previous_run = get_run_id_for_seq(seq - 1)
+            if previous_run is None:
+                rebuild_baseline(run_id, seq)
+                return []
+            rebuild_baseline(previous_run, seq - 1)
+
+        port_changes, touched_hosts = fold_ports(run_id, seq)
+        host_changes = fold_hosts(sorted(touched_hosts), seq)
+        anomalies = host_changes + window_expired(seq) + port_changes
+        conn.executemany(
+            'INSERT INTO anomalies (run_id, kind, host, port, old, new) VALUES (?, ?, ?, ?, ?, ?)',
+            [(run_id, *change) for change in anomalies]
+        )
+        set_baseline_state(run_id, seq)
+    return anomalies
@@ -0,0 +1,784 @@
+"""
+Benchmarks for the NetworkMonitor storage layer.
+Runs against a throwaway database in a temporary directory, never the
+network_scans.db next to this file.
+
+Run with: python benchmark.py ingest --sizes 10000 100000 1000000
+          python benchmark.py diff --rows 100000
+          python benchmark.py baseline --rows 20000 --runs 50
+          python benchmark.py stress --readers 8 --runs 20
+          python benchmark.py retention --rows 20000 --runs 48 --keep 12
+          python benchmark.py voice --requests 200 --concurrency 20
+          python benchmark.py imports
+          python benchmark.py export --rows 100000 --runs 10
+          python benchmark.py replay --networks 10.0.0.0/24 10.0.0.0/20 --save-baseline replay.json
+          python benchmark.py replay --networks 10.0.0.0/24 10.0.0.0/20 --baseline replay.json
+"""
+import argparse
+import asyncio
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from ipaddress import ip_network
+from time import perf_counter, sleep
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Milliseconds our own code may add to importing each entry point, on top of
+# the web framework it is built on.
+IMPORT_BUDGETS_MS = {'api': 80, 'main': 80, 'database': 20, 'scanner': 50}
+FRAMEWORK_MODULES = {'fastapi', 'starlette', 'pydantic', 'anyio'}
+# Loaded on first use only.
+DEFERRED_MODULES = {'speech_recognition', 'nmap', 'netifaces', 'apscheduler'}
+SERVICES = [('http', 'nginx 1.24'), ('ssh', 'OpenSSH 9.6'), ('https', 'nginx 1.24'),
+            ('rtsp', ''), ('domain', 'dnsmasq 2.90'), ('microsoft-ds', '')]
+# Replay results compared against a saved baseline, and whether a higher value is better.
+REPLAY_METRICS = {
+    'ingest_rows_per_s': True, 'baseline_ms': False,
+    'logs_p50_ms': False, 'logs_p99_ms': False, 'logs_per_s': True, 'peak_rss_mb': False,
+}
+# Latency changes smaller than this are noise, whatever the percentage.
+REPLAY_NOISE_MS = 5
+
+
+def open_database():
+    workdir = tempfile.mkdtemp(prefix='netmon-bench-')
+    os.environ['NETWORK_MONITOR_DB'] = os.path.join(workdir, 'network_scans.db')
+    sys.path.insert(0, HERE)
+    import database
+    return database, workdir
+
+def synthetic_scan(n_ports, seed=0):
+    """Yields n_ports (host, port, state, service, version) rows spread over a /16."""
+    rng = random.Random(seed)
+    for i in range(n_ports):
+        host = f"10.{(i // 65536) % 256}.{(i // 256) % 256}.{i % 256}"
+        service, version = rng.choice(SERVICES)
+        yield host, rng.randint(1, 65535), 'open', service, version
+
+def bench_ingest(database, sizes, legacy_rows):
+    print(f"{'rows':>9} {'mode':>8} {'seconds':>9} {'rows/s':>11}")
+    if legacy_rows:
+        # Old path: one INSERT + commit per row.
+        run_id = database.start_scan_run()
+        conn = database.get_connection()
+        start = perf_counter()
+        for row in synthetic_scan(legacy_rows):
+            conn.execute('''
+                INSERT INTO scans (timestamp, host, port, state, service, version, run_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (datetime.now(), *row, run_id))
+            conn.commit()
+        elapsed = perf_counter() - start
+        print(f"{legacy_rows:>9} {'per-row':>8} {elapsed:>9.2f} {legacy_rows / elapsed:>11.0f}")
+
+    for size in sizes:
+        start = perf_counter()
+        run_id = database.start_scan_run()
+        inserted = database.insert_scan_results_bulk(run_id, synthetic_scan(size))
+        database.finish_scan_run(run_id)
+        elapsed = perf_counter() - start
+        print(f"{inserted:>9} {'bulk':>8} {elapsed:>9.2f} {inserted / elapsed:>11.0f}")
+
+def perturbed_scan(rows, change_rate, seed=1):
+    """Copies rows, dropping, adding and re-versioning about change_rate of them."""
+    rng = random.Random(seed)
+    for host, port, state, service, version in rows:
+        roll = rng.random()
+        if roll < change_rate / 3:
+            continue
+        if roll < 2 * change_rate / 3:
+            version = version + ' (patched)'
+        yield host, port, state, service, version
+        if rng.random() < change_rate / 3:
+            yield host, rng.randint(1, 65535), 'open', 'http', ''
+
+def legacy_diff(database, previous, latest):
+    """The pre-SQL detector: load both runs into Python sets."""
+    cursor = database.get_connection().cursor()
+    latest_scan = cursor.execute('SELECT host, port FROM scans WHERE run_id = ?', (latest,)).fetchall()
+    previous_scan = cursor.execute('SELECT host, port FROM scans WHERE run_id = ?', (previous,)).fetchall()
+    latest_hosts = {host for host, _ in latest_scan}
+    previous_hosts = {host for host, _ in previous_scan}
+    return len(latest_hosts - previous_hosts) + len(set(latest_scan) - set(previous_scan))
+
+def reseed_baseline(database, previous, latest):
+    """Forgets latest's anomalies and seeds the baseline from previous (the first run) alone."""
+    import baseline
+    conn = database.get_connection()
+    with conn:
+        conn.execute('DELETE FROM anomalies WHERE run_id = ?', (latest,))
+        conn.execute('DELETE FROM baseline_state')
+    baseline.update_baseline(previous)
+
+def bench_diff(database, rows, change_rate, repeats):
+    """Time to fold a run into a baseline seeded from the one before, as a scan job does, against the old set diff."""
+    import baseline
+    base = list(synthetic_scan(rows))
+    previous = database.start_scan_run()
+    database.insert_scan_results_bulk(previous, base)
+    database.finish_scan_run(previous)
+    latest = database.start_scan_run()
+    database.insert_scan_results_bulk(latest, perturbed_scan(base, change_rate))
+    database.finish_scan_run(latest)
+
+    for label, setup, fn in (
+            ('baseline', lambda: reseed_baseline(database, previous, latest),
+             lambda: len(baseline.update_baseline(latest))),
+            ('legacy', lambda: None, lambda: legacy_diff(database, previous, latest))):
+        timings = []
+        for _ in range(repeats):
+            setup()
+            start = perf_counter()
+            changes = fn()
+            timings.append(perf_counter() - start)
+        print(f"{label:>8}: {rows} rows/run, {changes} changes, best of {repeats}: {min(timings) * 1000:.1f} ms")
+
+def bench_baseline(database, rows, runs, change_rate):
+    """Time to fold each new run into the baseline as the number of stored runs grows."""
+    import baseline
+    current = list(synthetic_scan(rows))
+    print(f"{'run':>5} {'scan rows':>10} {'anomalies':>10} {'ms':>8}")
+    for n in range(1, runs + 1):
+        run_id = database.start_scan_run()
+        database.insert_scan_results_bulk(run_id, current)
+        database.finish_scan_run(run_id)
+        start = perf_counter()
+        anomalies = baseline.update_baseline(run_id)
+        elapsed = perf_counter() - start
+        if n == 1 or n % max(1, runs // 10) == 0:
+            total = database.get_connection().execute('SELECT COUNT(*) FROM scans').fetchone()[0]
+            print(f"{n:>5} {total:>10} {len(anomalies):>10} {elapsed * 1000:>8.1f}")
+        current = list(perturbed_scan(current, change_rate, seed=n))
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def connection_bursts(database, bursts, threads):
+    """
+    Runs bursts of short-lived threads that each read through the pool, the
+    way FastAPI's worker threads come and go with traffic. Returns False if
+    connections outlive their threads.
+    """
+    ok = True
+    for n in range(bursts):
+        workers = [threading.Thread(target=lambda: database.get_connection().execute(
+            'SELECT * FROM scans ORDER BY timestamp DESC, id DESC LIMIT 100').fetchall()) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        pooled, alive = len(database.connections), threading.active_count()
+        print(f"After burst {n + 1} of {threads} threads: {pooled} pooled connections, {alive} live threads")
+        if pooled > alive:
+            print("Pooled connections outlived their threads!")
+            ok = False
+    return ok
+
+def bench_stress(database, readers, runs, rows, bursts):
+    """
+    Ingests runs on one thread while reader threads query the database the
+    way the API does, each through its own pooled connection. Reports read
+    latency during ingestion and any errors (e.g. "database is locked"),
+    then checks that connections are released as threads exit.
+    """
+    import anomaly_detector
+    stop = threading.Event()
+    read_timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def reader(n):
+        conn = database.get_connection()
+        rng = random.Random(n)
+        while not stop.is_set():
+            start = perf_counter()
+            try:
+                latest = database.get_latest_run_id()
+                if rng.random() < 0.5:
+                    conn.execute('SELECT * FROM scans ORDER BY timestamp DESC, id DESC LIMIT 100').fetchall()
+                elif latest:
+                    conn.execute('SELECT * FROM scans WHERE run_id = ? AND host = ?',
+                                 (latest, f"10.0.0.{rng.randint(0, 255)}")).fetchall()
+                database.get_latest_summary()
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            with lock:
+                read_timings.append(perf_counter() - start)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    for thread in threads:
+        thread.start()
+    start = perf_counter()
+    current = list(synthetic_scan(rows))
+    for n in range(runs):
+        run_id = database.start_scan_run()
+        database.insert_scan_results_bulk(run_id, current)
+        database.finish_scan_run(run_id)
+        database.insert_summary(f"run {run_id}: {len(anomaly_detector.detect_anomalies())} changes")
+        current = list(perturbed_scan(current, 0.01, seed=n))
+    elapsed = perf_counter() - start
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    print(f"Ingested {runs} runs of {rows} rows in {elapsed:.2f}s ({runs * rows / elapsed:.0f} rows/s) "
+          f"with {readers} concurrent readers.")
+    if read_timings:
+        print(f"Reads: {len(read_timings)} ({len(read_timings) / elapsed:.0f}/s), "
+              f"p50 {percentile(read_timings, 0.5) * 1000:.1f} ms, p99 {percentile(read_timings, 0.99) * 1000:.1f} ms")
+    print(f"Errors: {len(errors)}" + (f" (first: {errors[0]})" if errors else ""))
+    return connection_bursts(database, bursts, readers) and not errors
+
+def time_queries(database, old_run, latest_run, repeats):
+    """Best-of-repeats milliseconds for the queries that read scan history."""
+    conn = database.get_connection()
+    queries = {
+        'logs page': lambda: conn.execute(
+            'SELECT * FROM scans ORDER BY timestamp DESC, id DESC LIMIT 100').fetchall(),
+        'latest run': lambda: database.get_run_results(latest_run),
+        'old run': lambda: database.get_run_results(old_run),
+    }
+    results = {}
+    for name, query in queries.items():
+        timings = []
+        for _ in range(repeats):
+            start = perf_counter()
+            query()
+            timings.append(perf_counter() - start)
+        results[name] = min(timings) * 1000
+    return results
+
+def bench_retention(database, rows, runs, keep, change_rate, repeats):
+    import retention
+    retention.RETENTION_FULL_RUNS = keep
+    current = list(synthetic_scan(rows))
+    run_ids = []
+    for n in range(runs):
+        run_id = database.start_scan_run()
+        database.insert_scan_results_bulk(run_id, current)
+        database.finish_scan_run(run_id)
+        run_ids.append(run_id)
+        current = list(perturbed_scan(current, change_rate, seed=n))
+    retention.reclaim_space()
+    old_run, latest_run = run_ids[0], run_ids[-1]
+    old_results = database.get_run_results(old_run)
+
+    size_before = retention.database_size()
+    before = time_queries(database, old_run, latest_run, repeats)
+    start = perf_counter()
+    compacted = retention.compact_history()
+    elapsed = perf_counter() - start
+    size_after = retention.database_size()
+    after = time_queries(database, old_run, latest_run, repeats)
+
+    conn = database.get_connection()
+    scans_rows = conn.execute('SELECT COUNT(*) FROM scans').fetchone()[0]
+    interval_rows = conn.execute('SELECT COUNT(*) FROM scan_intervals').fetchone()[0]
+    print(f"{runs} runs of {rows} rows, keeping {keep} in full: compacted {compacted} runs in {elapsed:.2f}s")
+    print(f"Rows: {scans_rows} in scans + {interval_rows} intervals (was {runs * rows} in scans)")
+    print(f"Size on disk: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB")
+    for name in before:
+        print(f"{name:>11}: {before[name]:.2f} ms -> {after[name]:.2f} ms")
+    if database.get_run_results(old_run) != old_results:
+        print("Compacted results for the oldest run differ from the originals!")
+        return False
+    return True
+
+def timed(fn):
+    start = perf_counter()
+    result = fn()
+    return result, perf_counter() - start
+
+def bench_export(database, rows, runs, change_rate):
+    """
+    Size and time of exporting every run through the /logs NDJSON path, the
+    compact export and Parquet (if pyarrow is installed), then of loading
+    each back and building one host's open-port time series.
+    """
+    import export
+    from api import stream_ndjson
+    current = list(synthetic_scan(rows))
+    for n in range(runs):
+        run_id = database.start_scan_run()
+        database.insert_scan_results_bulk(run_id, current)
+        database.finish_scan_run(run_id)
+        current = list(perturbed_scan(current, change_rate, seed=n))
+    total = database.get_connection().execute('SELECT COUNT(*) FROM scans').fetchone()[0]
+    host = current[0][0]
+    workdir = os.path.dirname(os.environ['NETWORK_MONITOR_DB'])
+    paths = {name: os.path.join(workdir, f"export.{name}") for name in ('ndjson', 'nmscan', 'parquet')}
+
+    def write_ndjson():
+        with open(paths['ndjson'], 'w') as f:
+            for chunk in stream_ndjson('SELECT * FROM scans ORDER BY run_id, host, port', []):
+                f.write(chunk)
+
+    def load_ndjson():
+        counts = {}
+        with open(paths['ndjson']) as f:
+            for line in f:
+                row = json.loads(line)
+                if row['host'] == host and row['state'] == 'open':
+                    counts[row['run_id']] = counts.get(row['run_id'], 0) + 1
+        return counts
+
+    def load_nmscan():
+        return export.host_timeseries(export.load_export(paths['nmscan']), host)
+
+    def load_parquet():
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        table = pq.read_table(paths['parquet'], columns=['run_id', 'host', 'state'])
+        mask = pc.and_(pc.equal(table['host'].cast('string'), host), pc.equal(table['state'].cast('string'), 'open'))
+        return table.filter(mask).group_by('run_id').aggregate([('run_id', 'count')])
+
+    formats = [('ndjson', write_ndjson, load_ndjson),
+               ('nmscan', lambda: export.export_to_file(paths['nmscan']), load_nmscan)]
+    try:
+        import pyarrow  # noqa: F401
+        formats.append(('parquet', lambda: export.export_parquet(paths['parquet']), load_parquet))
+    except ImportError:
+        print("pyarrow not installed; skipping Parquet.")
+
+    print(f"{runs} runs, {total} rows; time series for {host}")
+    print(f"{'format':>8} {'MB':>8} {'export s':>9} {'load+query s':>13}")
+    for name, write, load in formats:
+        _, write_seconds = timed(write)
+        _, load_seconds = timed(load)
+        print(f"{name:>8} {os.path.getsize(paths[name]) / 1e6:>8.1f} {write_seconds:>9.2f} {load_seconds:>13.2f}")
+
+def silent_wav(seconds=1.0, rate=16000):
+    import wave
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b'\0\0' * int(seconds * rate))
+    return buffer.getvalue()
+
+def bench_voice(requests, concurrency, latency_ms):
+    """
+    Sends concurrent /voice-command uploads through api.app in-process.
+    Speech recognition is replaced by a sleep of latency_ms so no audio
+    leaves the machine; decoding the upload still runs for real. Cheap
+    requests are sent alongside to show the event loop stays responsive.
+    """
+    import httpx
+    import api
+
+    def fake_transcribe(recognizer, audio_data):
+        sleep(latency_ms / 1000)
+        return "what's new"
+
+    api.transcribe = fake_transcribe
+    audio = silent_wav()
+
+    async def run():
+        timings, statuses, probe_timings = [], {}, []
+        semaphore = asyncio.Semaphore(concurrency)
+        done = asyncio.Event()
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            async def one():
+                async with semaphore:
+                    start = perf_counter()
+                    response = await client.post('/voice-command', files={'audio': ('command.wav', audio, 'audio/wav')})
+                    timings.append(perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            async def probe():
+                while not done.is_set():
+                    start = perf_counter()
+                    await client.get('/jobs/0')
+                    probe_timings.append(perf_counter() - start)
+                    await asyncio.sleep(0.01)
+
+            prober = asyncio.create_task(probe())
+            start = perf_counter()
+            await asyncio.gather(*(one() for _ in range(requests)))
+            elapsed = perf_counter() - start
+            done.set()
+            await prober
+        return elapsed, timings, statuses, probe_timings
+
+    elapsed, timings, statuses, probe_timings = asyncio.run(run())
+    print(f"{requests} voice commands, {concurrency} concurrent, {latency_ms} ms simulated recognition, "
+          f"{api.VOICE_WORKERS} workers + {api.VOICE_QUEUE_SIZE} queued")
+    print(f"Throughput: {requests / elapsed:.1f} req/s; statuses: {statuses}")
+    print(f"Voice latency: p50 {percentile(timings, 0.5) * 1000:.0f} ms, p99 {percentile(timings, 0.99) * 1000:.0f} ms")
+    if probe_timings:
+        print(f"Other requests meanwhile: {len(probe_timings)}, "
+              f"p50 {percentile(probe_timings, 0.5) * 1000:.1f} ms, p99 {percentile(probe_timings, 0.99) * 1000:.1f} ms")
+
+def measure_import(module, db_path):
+    """
+    Imports module in a fresh interpreter under -X importtime. Returns
+    (own ms, framework ms, top-level packages loaded).
+    """
+    env = dict(os.environ, NETWORK_MONITOR_DB=db_path)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=HERE, env=env, capture_output=True, text=True, check=True)
+    total = framework = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line or 'self [us]' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        loaded.add(name.split('.')[0])
+        if name == module:
+            total = int(cumulative)
+        elif name in FRAMEWORK_MODULES:
+            # -X importtime only lists a package under whoever imported it first.
+            framework += int(cumulative) if depth <= 2 else 0
+    return (total - framework) / 1000, framework / 1000, loaded
+
+def bench_imports(repeats):
+    """Checks each entry point's import time against IMPORT_BUDGETS_MS and that nothing heavy loads eagerly."""
+    db_path = os.path.join(tempfile.mkdtemp(prefix='netmon-bench-'), 'network_scans.db')
+    ok = True
+    print(f"{'module':>9} {'own ms':>8} {'budget':>7} {'framework ms':>13}  deferred modules loaded")
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        runs = [measure_import(module, db_path) for _ in range(repeats)]
+        own = min(run[0] for run in runs)
+        framework = min(run[1] for run in runs)
+        eager = sorted(DEFERRED_MODULES & runs[0][2])
+        within = own <= budget and not eager
+        ok = ok and within
+        print(f"{module:>9} {own:>8.1f} {budget:>7} {framework:>13.1f}  {', '.join(eager) or '-'}"
+              f"{'' if within else '  OVER BUDGET'}")
+    if os.path.exists(db_path):
+        print("Importing created the database file; schema setup should wait for the first connection.")
+        ok = False
+    return ok
+
+def synthetic_nmap_xml(network_range, up_fraction=0.5, max_ports=8, seed=0):
+    """An nmap -sV XML report in which about up_fraction of network_range's addresses are up."""
+    rng = random.Random(seed)
+    root = ET.Element('nmaprun', scanner='nmap', args=f'nmap -sV {network_range}')
+    up = 0
+    for address in ip_network(network_range).hosts():
+        if rng.random() >= up_fraction:
+            continue
+        up += 1
+        host = ET.SubElement(root, 'host')
+        ET.SubElement(host, 'status', state='up', reason='syn-ack')
+        ET.SubElement(host, 'address', addr=str(address), addrtype='ipv4')
+        ports = ET.SubElement(host, 'ports')
+        for port in sorted(rng.sample(range(1, 65536), rng.randint(1, max_ports))):
+            service, version = rng.choice(SERVICES)
+            element = ET.SubElement(ports, 'port', protocol='tcp', portid=str(port))
+            ET.SubElement(element, 'state', state='open', reason='syn-ack')
+            product, _, number = version.partition(' ')
+            ET.SubElement(element, 'service', name=service, product=product, version=number, method='probed')
+    runstats = ET.SubElement(root, 'runstats')
+    ET.SubElement(runstats, 'finished', time='0', timestr='', elapsed='0')
+    total = ip_network(network_range).num_addresses
+    ET.SubElement(runstats, 'hosts', up=str(up), down=str(total - up), total=str(total))
+    return ET.tostring(root, encoding='unicode')
+
+def load_nmap_hosts(xml_text):
+    """address -> <host> element for every host in an nmap XML report."""
+    return {host.find("address[@addrtype='ipv4']").get('addr'): host
+            for host in ET.fromstring(xml_text).iter('host')}
+
+def perturb_host(host, address, change_rate):
+    """Closes and re-versions about change_rate of a (copied) host's ports, the same way every time."""
+    rng = random.Random(address)
+    ports = host.find('ports')
+    for port in list(ports if ports is not None else []):
+        roll = rng.random()
+        if roll < change_rate / 2:
+            ports.remove(port)
+        elif roll < change_rate:
+            service = port.find('service')
+            service.set('version', service.get('version', '') + ' (patched)')
+
+def shard_report(hosts_by_address, targets, arguments, change_rate=0.0):
+    """
+    The part of a recorded report nmap would have printed for one
+    scan_network task, with change_rate of ports changed (see perturb_host).
+    Hosts are copied per task rather than up front, so the report is held
+    in memory only once however many runs are replayed.
+    """
+    try:
+        addresses = [str(address) for address in ip_network(targets, strict=False)]
+    except ValueError:
+        addresses = targets.split()
+    root = ET.Element('nmaprun', scanner='nmap', args=f'nmap {arguments} {targets}')
+    wanted_ports = None
+    if ' -p ' in f' {arguments} ':
+        wanted_ports = set(arguments.split(' -p ')[1].split()[0].split(','))
+    up = 0
+    for address in addresses:
+        host = hosts_by_address.get(address)
+        if host is None:
+            continue
+        up += 1
+        host = copy.deepcopy(host)
+        if change_rate:
+            perturb_host(host, address, change_rate)
+        ports = host.find('ports')
+        if ports is not None:
+            for port in list(ports):
+                if '-sn' in arguments or (wanted_ports is not None and port.get('portid') not in wanted_ports):
+                    ports.remove(port)
+        root.append(host)
+    runstats = ET.SubElement(root, 'runstats')
+    ET.SubElement(runstats, 'finished', time='0', timestr='', elapsed='0')
+    ET.SubElement(runstats, 'hosts', up=str(up), down=str(len(addresses) - up), total=str(len(addresses)))
+    return ET.tostring(root, encoding='unicode')
+
+def install_replay(hosts_by_address):
+    """
+    Makes scanner.run_nmap answer from hosts_by_address instead of running
+    nmap. Parsing still goes through python-nmap's own XML reader, so only
+    the network round trip is left out.
+    """
+    import nmap
+
+    class ReplayScanner(nmap.PortScanner):
+        def __init__(self):
+            # The real constructor looks for an nmap binary, which a replay doesn't need.
+            self._scan_result = {}
+            self._nmap_last_output = ''
+
+        def scan(self, hosts, arguments):
+            return self.analyse_nmap_xml_scan(
+                shard_report(hosts_by_address, hosts, arguments, replay['change_rate']))
+
+    replay = {'change_rate': 0.0}
+    nmap.PortScanner = ReplayScanner
+    return replay
+
+def stage_seconds(stage):
+    import metrics
+    values = metrics.histograms.get('scan_stage_seconds', {}).get((('stage', stage),))
+    return values[-2] if values else 0.0
+
+async def load_logs(app, requests, concurrency, page_size):
+    """GETs /logs pages concurrently, following next_cursor. Returns (elapsed, latencies, errors)."""
+    import httpx
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        cursor = None
+
+        async def one():
+            nonlocal cursor, errors
+            async with semaphore:
+                params = {'limit': page_size}
+                if cursor:
+                    params['cursor'] = cursor
+                start = perf_counter()
+                response = await client.get('/logs', params=params)
+                latencies.append(perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+                    return
+                cursor = response.json()['next_cursor']
+
+        start = perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return perf_counter() - start, latencies, errors
+
+def replay_one(network_range, xml_path, change_rate, requests, concurrency, page_size):
+    """
+    Replays two scans of network_range through scan_network (the second with
+    change_rate of ports changed) and load-tests /logs. Meant to run in its
+    own process so peak RSS belongs to this data size alone.
+    """
+    database, _ = open_database()
+    import anomaly_detector
+    import api
+    import scanner
+
+    if xml_path:
+        with open(xml_path) as f:
+            hosts = load_nmap_hosts(f.read())
+    else:
+        hosts = load_nmap_hosts(synthetic_nmap_xml(network_range))
+    replay = install_replay(hosts)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        start = perf_counter()
+        scanner.scan_network(network_range, mode='full')
+        ingest_seconds = perf_counter() - start
+        previous = database.get_latest_run_id()
+        rows = database.fetch_value('SELECT COUNT(*) FROM scans WHERE run_id = ?', (previous,))
+        first_baseline = stage_seconds('diff')
+        replay['change_rate'] = change_rate
+        scanner.scan_network(network_range, mode='full')
+    latest = database.get_latest_run_id()
+    if latest == previous:
+        raise RuntimeError('Replayed scan did not complete:\n' + log.getvalue())
+    # Stored by the scan's baseline update.
+    changes = len(anomaly_detector.detect_anomalies())
+    # Best of three, since a single round of /logs requests is noisy.
+    rounds = [asyncio.run(load_logs(api.app, requests, concurrency, page_size)) for _ in range(3)]
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != 'darwin' else 1024 * 1024)
+    return {
+        'network': network_range, 'hosts': len(hosts), 'rows': rows, 'changes': changes,
+        'ingest_rows_per_s': round(rows / ingest_seconds, 1),
+        # The second run's baseline update; the first only seeds it.
+        'baseline_ms': round((stage_seconds('diff') - first_baseline) * 1000, 2),
+        'logs_p50_ms': round(min(percentile(latencies, 0.5) for _, latencies, _ in rounds) * 1000, 2),
+        'logs_p99_ms': round(min(percentile(latencies, 0.99) for _, latencies, _ in rounds) * 1000, 2),
+        'logs_per_s': round(requests / min(elapsed for elapsed, _, _ in rounds), 1),
+        'logs_errors': sum(errors for _, _, errors in rounds),
+        'peak_rss_mb': round(peak_rss, 1),
+    }
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Prints each metric that is worse than the baseline by more than tolerance. Returns True if none are."""
+    previous = {entry['network']: entry for entry in baseline}
+    ok = True
+    for result in results:
+        old = previous.get(result['network'])
+        if old is None:
+            print(f"{result['network']}: not in baseline")
+            continue
+        for metric, higher_is_better in REPLAY_METRICS.items():
+            if not old.get(metric):
+                continue
+            if metric.endswith('_ms') and abs(result[metric] - old[metric]) < REPLAY_NOISE_MS:
+                continue
+            change = result[metric] / old[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                ok = False
+                print(f"REGRESSION {result['network']} {metric}: {old[metric]} -> {result[metric]} ({change:+.0%})")
+    if ok:
+        print(f"No regressions beyond {tolerance:.0%} of the baseline.")
+    return ok
+
+def bench_replay(args):
+    """
+    Replays recorded (--xml) or synthetic nmap reports through the real
+    parsing and ingestion path, one process per network size, and optionally
+    saves or compares against a baseline.
+    """
+    results = []
+    print(f"{'network':>16} {'hosts':>7} {'rows':>8} {'rows/s':>9} {'changes':>8} {'base ms':>8} "
+          f"{'logs p50':>9} {'logs p99':>9} {'logs/s':>8} {'RSS MB':>7}")
+    for network_range in args.networks:
+        command = [sys.executable, os.path.abspath(__file__), 'replay-one', network_range,
+                   '--change-rate', str(args.change_rate), '--requests', str(args.requests),
+                   '--concurrency', str(args.concurrency), '--page-size', str(args.page_size)]
+        if args.xml:
+            command += ['--xml', args.xml]
+        output = subprocess.run(command, cwd=HERE, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{result['network']:>16} {result['hosts']:>7} {result['rows']:>8} {result['ingest_rows_per_s']:>9.0f} "
+              f"{result['changes']:>8} {result['baseline_ms']:>8.1f} {result['logs_p50_ms']:>9.1f} "
+              f"{result['logs_p99_ms']:>9.1f} {result['logs_per_s']:>8.0f} {result['peak_rss_mb']:>7.0f}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            return compare_to_baseline(results, json.load(f), args.tolerance)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    ingest = sub.add_parser('ingest', help='Rows per second for synthetic scans.')
+    ingest.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    ingest.add_argument('--legacy-rows', type=int, default=2000,
+                        help='Rows to insert through the old commit-per-row path for comparison (0 to skip).')
+    diff = sub.add_parser('diff', help='Baseline update time for a run against the one before.')
+    diff.add_argument('--rows', type=int, default=100000)
+    diff.add_argument('--change-rate', type=float, default=0.01)
+    diff.add_argument('--repeats', type=int, default=5)
+    base = sub.add_parser('baseline', help='Baseline update time per run as history grows.')
+    base.add_argument('--rows', type=int, default=20000)
+    base.add_argument('--runs', type=int, default=50)
+    base.add_argument('--change-rate', type=float, default=0.01)
+    stress = sub.add_parser('stress', help='Concurrent reads while runs are ingested.')
+    stress.add_argument('--readers', type=int, default=8)
+    stress.add_argument('--runs', type=int, default=20)
+    stress.add_argument('--rows', type=int, default=20000)
+    stress.add_argument('--bursts', type=int, default=5, help='Bursts of short-lived reader threads afterwards.')
+    retain = sub.add_parser('retention', help='Size and query latency before and after compaction.')
+    retain.add_argument('--rows', type=int, default=20000)
+    retain.add_argument('--runs', type=int, default=48)
+    retain.add_argument('--keep', type=int, default=12, help='Runs kept in full.')
+    retain.add_argument('--change-rate', type=float, default=0.01)
+    retain.add_argument('--repeats', type=int, default=5)
+    voice = sub.add_parser('voice', help='Concurrent /voice-command uploads with simulated recognition.')
+    voice.add_argument('--requests', type=int, default=200)
+    voice.add_argument('--concurrency', type=int, default=20)
+    voice.add_argument('--latency-ms', type=int, default=200, help='Simulated recognition time per command.')
+    exp = sub.add_parser('export', help='Size and time of the compact export against the NDJSON /logs path.')
+    exp.add_argument('--rows', type=int, default=100000)
+    exp.add_argument('--runs', type=int, default=10)
+    exp.add_argument('--change-rate', type=float, default=0.01)
+    imports = sub.add_parser('imports', help='Import time of each entry point against a budget.')
+    imports.add_argument('--repeats', type=int, default=5)
+    replay = sub.add_parser('replay', help='Replay nmap XML through scan_network and load /logs, per network size.')
+    replay.add_argument('--networks', nargs='+', default=['10.0.0.0/24', '10.0.0.0/20', '10.0.0.0/16'])
+    replay.add_argument('--xml', help='Recorded nmap -sV -oX report to replay instead of a synthetic one.')
+    replay.add_argument('--save-baseline', help='Write the results to this JSON file.')
+    replay.add_argument('--baseline', help='Compare against results saved with --save-baseline.')
+    replay.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before failing.')
+    replay_one_parser = sub.add_parser('replay-one')
+    replay_one_parser.add_argument('network')
+    replay_one_parser.add_argument('--xml')
+    for parser_ in (replay, replay_one_parser):
+        parser_.add_argument('--change-rate', type=float, default=0.01)
+        parser_.add_argument('--requests', type=int, default=500, help='/logs requests.')
+        parser_.add_argument('--concurrency', type=int, default=16)
+        parser_.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == 'imports':
+        sys.exit(0 if bench_imports(args.repeats) else 1)
+    if args.command == 'replay':
+        sys.exit(0 if bench_replay(args) else 1)
+    if args.command == 'replay-one':
+        print(json.dumps(replay_one(args.network, args.xml, args.change_rate, args.requests,
+                                    args.concurrency, args.page_size)))
+        return
+
+    database, workdir = open_database()
+    print(f"Using temporary database in {workdir}")
+    if args.command == 'ingest':
+        bench_ingest(database, args.sizes, args.legacy_rows)
+    elif args.command == 'diff':
+        bench_diff(database, args.rows, args.change_rate, args.repeats)
+    elif args.command == 'baseline':
+        bench_baseline(database, args.rows, args.runs, args.change_rate)
+    elif args.command == 'stress':
+        if not bench_stress(database, args.readers, args.runs, args.rows, args.bursts):
+            sys.exit(1)
+    elif args.command == 'export':
+        bench_export(database, args.rows, args.runs, args.change_rate)
+    elif args.command == 'voice':
+        bench_voice(args.requests, args.concurrency, args.latency_ms)
+    elif args.command == 'retention':
+        if not bench_retention(database, args.rows, args.runs, args.keep, args.change_rate, args.repeats):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
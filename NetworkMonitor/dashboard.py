@@ -0,0 +1,83 @@
+import hashlib
+import json
+import threading
+from collections import Counter
+from datetime import datetime
+from time import monotonic
+from database import get_connection, get_latest_run_id, get_latest_summary
+import metrics
+
+TOP_SERVICES = 10
+# api.py and main.py may run as separate processes over the same database,
+# so a scan finished by the other one is picked up by checking this often
+# whether the latest run or summary changed.
+RECHECK_INTERVAL = 30
+
+# The rendered /dashboard body and its ETag. Rebuilt when a scan job in
+# this process finishes; between scans requests don't touch SQLite beyond
+# the periodic recheck.
+snapshot = None
+snapshot_lock = threading.Lock()
+last_checked = 0.0
+
+def current_version():
+    """(latest completed run id, latest summary id): changes whenever the snapshot would."""
+    summary_id = get_connection().execute('SELECT MAX(id) FROM summaries').fetchone()[0]
+    return get_latest_run_id(), summary_id
+
+def build_snapshot():
+    """Aggregates the latest completed run and summary into a rendered snapshot."""
+    version = current_version()
+    run_id = version[0]
+    ports_per_host = Counter()
+    services = Counter()
+    finished_at = None
+    if run_id:
+        conn = get_connection()
+        finished_at = conn.execute('SELECT finished_at FROM scan_runs WHERE id = ?', (run_id,)).fetchone()[0]
+        for host, service in conn.execute(
+                "SELECT host, service FROM scans WHERE run_id = ? AND state = 'open'", (run_id,)):
+            ports_per_host[host] += 1
+            services[service or 'unknown'] += 1
+    data = {
+        'run_id': run_id,
+        'scanned_at': finished_at,
+        'latest_summary': get_latest_summary(),
+        'host_count': len(ports_per_host),
+        'open_ports': sum(ports_per_host.values()),
+        'ports_per_host': dict(sorted(ports_per_host.items())),
+        'top_services': [{'service': service, 'count': count} for service, count in services.most_common(TOP_SERVICES)],
+        'generated_at': datetime.now().isoformat(),
+    }
+    body = json.dumps(data).encode()
+    # generated_at changes every rebuild; leave it out so an unchanged network keeps its ETag.
+    stable = json.dumps({key: value for key, value in data.items() if key != 'generated_at'}).encode()
+    return {
+        'body': body,
+        'etag': '"' + hashlib.sha1(stable).hexdigest() + '"',
+        'summary': data['latest_summary'],
+        'version': version,
+    }
+
+def refresh_dashboard():
+    global snapshot, last_checked
+    fresh = build_snapshot()
+    with snapshot_lock:
+        snapshot = fresh
+        last_checked = monotonic()
+    return fresh
+
+def get_dashboard():
+    """Returns the current snapshot, building it on first use or if another process has scanned since."""
+    global last_checked
+    current = snapshot
+    if current is None:
+        metrics.inc('dashboard_requests_total', result='rebuilt')
+        return refresh_dashboard()
+    if monotonic() - last_checked >= RECHECK_INTERVAL:
+        last_checked = monotonic()
+        if current_version() != current['version']:
+            metrics.inc('dashboard_requests_total', result='rebuilt')
+            return refresh_dashboard()
+    metrics.inc('dashboard_requests_total', result='cached')
+    return current
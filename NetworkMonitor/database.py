@@ -1,56 +1,421 @@
+import json
+import os
+import re
 import sqlite3
+import threading
+import weakref
 from datetime import datetime
+from functools import lru_cache
+from time import perf_counter
+import metrics
 
-# Connect to the database
-conn = sqlite3.connect('network_scans.db')
-cursor = conn.cursor()
-
-# Create the scans table if it doesn't exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS scans (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp DATETIME,
-        host TEXT,
-        port INTEGER,
-        state TEXT,
-        service TEXT,
-        version TEXT
-    )
-''')
-
-# Create the summaries table if it doesn't exist
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS summaries (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp DATETIME,
-        summary TEXT
-    )
-''')
-conn.commit()
-
-def insert_scan_results(host, port, state, service, version):
-    timestamp = datetime.now()
-    cursor.execute('''
-        INSERT INTO scans (timestamp, host, port, state, service, version)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (timestamp, host, port, state, service, version))
+# Relative paths are resolved against the working directory, as before.
+DB_PATH = os.getenv('NETWORK_MONITOR_DB', 'network_scans.db')
+# sqlite3 keeps compiled statements per connection keyed by SQL text, so
+# the fixed queries below are prepared once per thread and then reused.
+STATEMENT_CACHE_SIZE = 256
+# Seconds a writer waits on another thread's write lock before giving up.
+BUSY_TIMEOUT = 30
+
+# Each thread (scan job, scheduler, FastAPI worker) gets its own connection;
+# sqlite3 connections and cursors aren't safe to share between threads.
+# The connection lives in a PooledConnection held only by the thread's
+# locals, so it is closed when the thread exits (FastAPI's worker threads
+# come and go with traffic). `connections` tracks the live ones weakly.
+local = threading.local()
+connections = weakref.WeakSet()
+connections_lock = threading.Lock()
+# The schema is created and migrated on the first connection rather than
+# at import, so importing this module doesn't touch the disk.
+schema_ready = False
+schema_lock = threading.Lock()
+
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=512)
+def statement_labels(sql):
+    """(statement, table) labels for sqlite_query_seconds, e.g. ('SELECT', 'scans')."""
+    words = sql.split(None, 1)
+    match = STATEMENT_TABLE.search(sql)
+    return (words[0].upper() if words else ''), (match.group(1) if match else '')
+
+class TimedCursor(sqlite3.Cursor):
+    """Records how long each execute() takes in the sqlite_query_seconds histogram."""
+    def execute(self, sql, parameters=()):
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            statement, table = statement_labels(sql)
+            metrics.observe('sqlite_query_seconds', perf_counter() - start, statement=statement, table=table)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            statement, table = statement_labels(sql)
+            metrics.observe('sqlite_query_seconds', perf_counter() - start, statement=statement, table=table)
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute() doesn't go through cursor(), so both are overridden.
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def open_connection(check_same_thread=True):
+    """Opens a new connection with the pragmas every connection needs."""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=check_same_thread, factory=TimedConnection)
+    # Only takes effect on a new, empty database (so it has to come before
+    # journal_mode); retention.py converts older ones.
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # WAL lets readers keep going while a scan is being written, and with WAL
+    # synchronous=NORMAL only syncs at checkpoints instead of on every commit.
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+def connect(check_same_thread=True):
+    """Opens a new connection, creating or migrating the schema first if this process hasn't yet."""
+    ensure_schema()
+    return open_connection(check_same_thread)
+
+class PooledConnection:
+    """One thread's connection, closed once the thread's locals are freed or on close()."""
+    def __init__(self):
+        # The thread's locals may be freed from another thread, so the
+        # connection must be closable from there.
+        self.conn = connect(check_same_thread=False)
+        self.close = weakref.finalize(self, self.conn.close)
+
+def get_connection():
+    """Returns this thread's connection, opening it on first use."""
+    pooled = getattr(local, 'pooled', None)
+    if pooled is None or not pooled.close.alive:
+        pooled = local.pooled = PooledConnection()
+        with connections_lock:
+            connections.add(pooled)
+    return pooled.conn
+
+def close_connections():
+    """Closes every pooled connection. Threads that use the pool afterwards reconnect."""
+    with connections_lock:
+        for pooled in list(connections):
+            pooled.close()
+        connections.clear()
+
+def pool_metrics():
+    yield ('sqlite_pooled_connections', 'gauge', 'Open thread-local SQLite connections.', [({}, len(connections))])
+
+metrics.collectors.append(pool_metrics)
+
+def ensure_schema():
+    global schema_ready
+    if schema_ready:
+        return
+    with schema_lock:
+        if schema_ready:
+            return
+        conn = open_connection()
+        try:
+            create_tables(conn)
+            migrate_legacy_scans(conn)
+            add_column_if_missing(conn, 'scan_runs', 'stage_timings', 'TEXT')
+            add_column_if_missing(conn, 'scan_runs', 'compacted_at', 'DATETIME')
+            add_column_if_missing(conn, 'schedule_state', 'flaps', 'INTEGER DEFAULT 0')
+            backfill_run_seq(conn)
+            create_indexes(conn)
+        finally:
+            conn.close()
+        schema_ready = True
+
+# Rows written before this many seconds of silence belong to the same run
+# when grouping legacy per-row timestamps into scan runs.
+LEGACY_RUN_GAP_SECONDS = 30
+
+def create_tables(conn):
+    """Creates any missing tables."""
+    # One row per scan of a network range; scans rows point at their run.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scan_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at DATETIME,
+            finished_at DATETIME,
+            network_range TEXT,
+            status TEXT,
+            stage_timings TEXT,
+            seq INTEGER
+        )
+    ''')
+
+    # Create the scans table if it doesn't exist
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME,
+            host TEXT,
+            port INTEGER,
+            state TEXT,
+            service TEXT,
+            version TEXT,
+            run_id INTEGER REFERENCES scan_runs(id)
+        )
+    ''')
+
+    # Per-port and per-host history maintained incrementally by baseline.py.
+    # Times are scan_runs.seq values. last_seen and seen_runs are only brought
+    # up to date when an entry goes absent; while present they are implied by
+    # present_since and the latest seq.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS port_baseline (
+            host TEXT,
+            port INTEGER,
+            service TEXT,
+            version TEXT,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            present_since INTEGER,
+            absent_since INTEGER,
+            seen_runs INTEGER,
+            present INTEGER,
+            PRIMARY KEY (host, port)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS host_baseline (
+            host TEXT PRIMARY KEY,
+            port_fingerprint TEXT,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            present_since INTEGER,
+            absent_since INTEGER,
+            seen_runs INTEGER,
+            present INTEGER
+        )
+    ''')
+    # Single row recording the last run folded into the baseline.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS baseline_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            run_id INTEGER,
+            seq INTEGER
+        )
+    ''')
+    # Anomalies flagged for each run against the baseline.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS anomalies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER REFERENCES scan_runs(id),
+            kind TEXT,
+            host TEXT,
+            port INTEGER,
+            old TEXT,
+            new TEXT
+        )
+    ''')
+
+    # Compacted history: each row is one (host, port) observation that was
+    # identical in every completed run from first_seq to last_seq. Runs
+    # older than the retention window live here instead of in scans.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS scan_intervals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host TEXT,
+            port INTEGER,
+            state TEXT,
+            service TEXT,
+            version TEXT,
+            first_seq INTEGER,
+            last_seq INTEGER
+        )
+    ''')
+
+    # Adaptive scheduling (see adaptive_scheduler.py): one row per shard or
+    # host that gets cheap checks, kept across restarts.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_state (
+            target TEXT PRIMARY KEY,
+            kind TEXT,
+            interval REAL,
+            next_due REAL,
+            last_checked REAL,
+            fingerprint TEXT,
+            seen_run_id INTEGER,
+            checks INTEGER DEFAULT 0,
+            changes INTEGER DEFAULT 0,
+            flaps INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Create the summaries table if it doesn't exist
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME,
+            summary TEXT
+        )
+    ''')
     conn.commit()
 
-def insert_summary(summary):
-    timestamp = datetime.now()
-    cursor.execute('INSERT INTO summaries (timestamp, summary) VALUES (?, ?)', (timestamp, summary))
+def migrate_legacy_scans(conn):
+    """
+    Adds scans.run_id to databases created before scan_runs existed and
+    groups their rows into runs. Legacy rows each carry their own
+    datetime.now(), so consecutive rows closer together than
+    LEGACY_RUN_GAP_SECONDS are treated as one run.
+    """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(scans)')]
+    if 'run_id' in columns:
+        return
+    print("Migrating scans table to scan runs...")
+    with conn:
+        conn.execute('ALTER TABLE scans ADD COLUMN run_id INTEGER REFERENCES scan_runs(id)')
+        runs = []
+        for row_id, timestamp in conn.execute('SELECT id, timestamp FROM scans ORDER BY id'):
+            moment = datetime.fromisoformat(str(timestamp))
+            if runs and (moment - runs[-1]['finished_at']).total_seconds() <= LEGACY_RUN_GAP_SECONDS:
+                runs[-1]['finished_at'] = moment
+                runs[-1]['last_id'] = row_id
+            else:
+                runs.append({'started_at': moment, 'finished_at': moment, 'first_id': row_id, 'last_id': row_id})
+        for run in runs:
+            run_id = conn.execute(
+                "INSERT INTO scan_runs (started_at, finished_at, status) VALUES (?, ?, 'complete')",
+                (run['started_at'], run['finished_at'])
+            ).lastrowid
+            conn.execute('UPDATE scans SET run_id = ? WHERE id BETWEEN ? AND ?',
+                         (run_id, run['first_id'], run['last_id']))
+    print(f"Migrated legacy scans into {len(runs)} runs.")
+
+def add_column_if_missing(conn, table, column, definition):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def backfill_run_seq(conn):
+    """Numbers completed runs 1, 2, 3... in id order for databases that predate seq."""
+    add_column_if_missing(conn, 'scan_runs', 'seq', 'INTEGER')
+    if conn.execute("SELECT 1 FROM scan_runs WHERE status = 'complete' AND seq IS NULL LIMIT 1").fetchone() is None:
+        return
+    with conn:
+        next_seq = conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM scan_runs').fetchone()[0]
+        pending = conn.execute("SELECT id FROM scan_runs WHERE status = 'complete' AND seq IS NULL ORDER BY id").fetchall()
+        for offset, (run_id,) in enumerate(pending):
+            conn.execute('UPDATE scan_runs SET seq = ? WHERE id = ?', (next_seq + offset, run_id))
+
+def create_indexes(conn):
+    """Creates any missing indexes."""
+    # Covers the per-run lookups used for anomaly detection, including the
+    # service/version comparison, so diffs never touch the table itself.
+    conn.execute('DROP INDEX IF EXISTS idx_scans_run_host_port')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scans_run_ports ON scans (run_id, host, port, service, version)')
+    # Latest/previous completed run lookups walk this index from the end.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_runs_status ON scan_runs (status, id)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_scan_runs_seq ON scan_runs (seq)')
+    # Entries that went absent at a given seq, for delayed disappearance alerts.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_port_baseline_absent ON port_baseline (absent_since) WHERE present = 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_host_baseline_absent ON host_baseline (absent_since) WHERE present = 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_anomalies_run ON anomalies (run_id)')
+    # Extending the intervals that end at the previous run, and point-in-time lookups.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_intervals_last ON scan_intervals (last_seq, host, port)')
+    # Keyset pagination of /logs and /summaries, newest first.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_scans_timestamp_id ON scans (timestamp, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_summaries_timestamp_id ON summaries (timestamp, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_schedule_state_due ON schedule_state (next_due)')
     conn.commit()
 
-def get_latest_timestamp():
-    cursor.execute('SELECT MAX(timestamp) FROM scans')
-    return cursor.fetchone()[0]
+def start_scan_run(network_range=None):
+    """Records the start of a scan and returns its run id."""
+    conn = get_connection()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO scan_runs (started_at, network_range, status) VALUES (?, ?, 'running')",
+            (datetime.now(), network_range)
+        )
+    return cur.lastrowid
+
+def finish_scan_run(run_id, status='complete', stage_timings=None):
+    """
+    Marks a run finished. stage_timings maps stage names to seconds.
+    Completed runs get the next seq number.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute('''
+            UPDATE scan_runs
+            SET finished_at = ?, status = ?, stage_timings = ?,
+                seq = CASE WHEN ? = 'complete' THEN (SELECT COALESCE(MAX(seq), 0) + 1 FROM scan_runs) END
+            WHERE id = ?
+        ''', (datetime.now(), status, json.dumps(stage_timings) if stage_timings else None, status, run_id))
 
-def get_previous_timestamp(latest):
-    cursor.execute('SELECT MAX(timestamp) FROM scans WHERE timestamp < ?', (latest,))
-    result = cursor.fetchone()
+def insert_scan_results_bulk(run_id, results):
+    """
+    Inserts results for a scan run in one transaction.
+    results is an iterable of (host, port, state, service, version) tuples.
+    Every row gets the run's start time as its timestamp.
+    Returns the number of rows inserted.
+    """
+    conn = get_connection()
+    with conn:
+        started_at = conn.execute('SELECT started_at FROM scan_runs WHERE id = ?', (run_id,)).fetchone()[0]
+        cur = conn.executemany('''
+            INSERT INTO scans (timestamp, host, port, state, service, version, run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', ((started_at, host, port, state, service, version, run_id)
+              for host, port, state, service, version in results))
+    metrics.inc('scan_rows_ingested_total', cur.rowcount)
+    return cur.rowcount
+
+def insert_scan_results(run_id, host, port, state, service, version):
+    insert_scan_results_bulk(run_id, [(host, port, state, service, version)])
+
+def insert_summary(summary):
+    conn = get_connection()
+    with conn:
+        conn.execute('INSERT INTO summaries (timestamp, summary) VALUES (?, ?)', (datetime.now(), summary))
+
+def fetch_value(sql, params=()):
+    """Returns the first column of the first row, or None if there are no rows."""
+    result = get_connection().execute(sql, params).fetchone()
     return result[0] if result else None
 
+def get_latest_run_id():
+    return fetch_value("SELECT id FROM scan_runs WHERE status = 'complete' ORDER BY id DESC LIMIT 1")
+
+def get_previous_run_id(latest):
+    return fetch_value("SELECT id FROM scan_runs WHERE status = 'complete' AND id < ? ORDER BY id DESC LIMIT 1",
+                       (latest,))
+
+def get_run_seq(run_id):
+    return fetch_value('SELECT seq FROM scan_runs WHERE id = ?', (run_id,))
+
+def get_run_id_for_seq(seq):
+    return fetch_value('SELECT id FROM scan_runs WHERE seq = ?', (seq,))
+
+def get_run_results(run_id):
+    """
+    Returns {(host, port): (state, service, version)} for one run, read
+    from scan_intervals if the run has been compacted.
+    """
+    conn = get_connection()
+    seq, compacted_at = conn.execute('SELECT seq, compacted_at FROM scan_runs WHERE id = ?', (run_id,)).fetchone()
+    if compacted_at is not None and seq is not None:
+        rows = conn.execute(
+            'SELECT host, port, state, service, version FROM scan_intervals WHERE last_seq >= ? AND first_seq <= ?',
+            (seq, seq))
+    else:
+        rows = conn.execute('SELECT host, port, state, service, version FROM scans WHERE run_id = ?', (run_id,))
+    return {(host, port): (state, service, version) for host, port, state, service, version in rows}
+
 def get_latest_summary():
-    cursor.execute('SELECT summary FROM summaries WHERE timestamp = (SELECT MAX(timestamp) FROM summaries)')
-    result = cursor.fetchone()
-    return result[0] if result else "No summaries available."
+    summary = fetch_value('SELECT summary FROM summaries ORDER BY timestamp DESC, id DESC LIMIT 1')
+    return summary if summary is not None else "No summaries available."
@@ -0,0 +1,259 @@
+import argparse
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime
+from database import connect
+
+# Compact scan history export: one chunk per completed run, so it can be
+# streamed and read back run by run. Strings (host, state, service,
+# version) are dictionary-encoded: each chunk carries only the strings not
+# seen in earlier chunks, and rows refer to them by code. Code 0 is NULL.
+#
+#   file  := MAGIC chunk*
+#   chunk := RUN_HEADER zlib(new strings for each of DICTIONARIES, then the
+#            port, host, state, service and version columns)
+#
+# Strings are a uint32 count followed by (uint32 length, UTF-8 bytes)
+# pairs. Ports are uint16 and codes uint32; everything is little-endian.
+# Rows within a run are ordered by host and port.
+MAGIC = b'NMSCAN1\n'
+# run id, seq, finished_at (Unix epoch seconds), row count, compressed length
+RUN_HEADER = struct.Struct('<IIdII')
+DICTIONARIES = ('host', 'state', 'service', 'version')
+# Level 1 is ~10% larger than the default but compresses in a third of the time.
+COMPRESSION_LEVEL = 1
+
+RUNS_IN_RANGE = '''
+    SELECT id FROM scan_runs
+    WHERE status = 'complete' AND id BETWEEN ? AND ?
+    ORDER BY seq
+'''
+
+def run_rows(conn, seq, run_id, compacted):
+    """A run's rows ordered by host and port, from scan_intervals if it has been compacted."""
+    if compacted:
+        return conn.execute('''
+            SELECT host, port, state, service, version FROM scan_intervals
+            WHERE last_seq >= ? AND first_seq <= ? ORDER BY host, port
+        ''', (seq, seq))
+    return conn.execute(
+        'SELECT host, port, state, service, version FROM scans WHERE run_id = ? ORDER BY host, port', (run_id,))
+
+def epoch_seconds(finished_at):
+    """Unix time of a stored finished_at, which is naive local time (datetime.now())."""
+    try:
+        return datetime.fromisoformat(str(finished_at)).timestamp()
+    except ValueError:
+        return 0.0
+
+def little_endian(column):
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+def encode_strings(values):
+    parts = [struct.pack('<I', len(values))]
+    for value in values:
+        data = value.encode()
+        parts.append(struct.pack('<I', len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def encoded_runs(conn, first_run=None, last_run=None):
+    """
+    Yields (run_id, seq, finished_at, columns, new_strings) for each completed
+    run in [first_run, last_run]. columns maps 'port' and each of
+    DICTIONARIES to an array; new_strings maps each of DICTIONARIES to the
+    strings first seen in this run, in code order.
+    """
+    codes = {name: {None: 0} for name in DICTIONARIES}
+    run_ids = [run_id for (run_id,) in conn.execute(RUNS_IN_RANGE, (first_run or 0, last_run or 2 ** 63 - 1))]
+    for run_id in run_ids:
+        # retention.compact_run may move a run's rows from scans to
+        # scan_intervals at any time, so check where they are and read them
+        # in one snapshot. One transaction per run, so a slow stream doesn't
+        # hold back WAL checkpoints for the whole export.
+        conn.execute('BEGIN')
+        try:
+            run = conn.execute('SELECT seq, finished_at, compacted_at FROM scan_runs WHERE id = ?',
+                               (run_id,)).fetchone()
+            if run is None:
+                continue
+            seq, finished_at, compacted_at = run
+            rows = run_rows(conn, seq, run_id, compacted_at is not None).fetchall()
+        finally:
+            conn.commit()
+        ports = array('H')
+        columns = {name: array('I') for name in DICTIONARIES}
+        new_strings = {name: [] for name in DICTIONARIES}
+        ports.extend(row[1] for row in rows)
+        for index, name in zip((0, 2, 3, 4), DICTIONARIES):
+            known, column, new = codes[name], columns[name], new_strings[name]
+            for value in (row[index] for row in rows):
+                code = known.get(value)
+                if code is None:
+                    code = known[value] = len(known)
+                    new.append(value)
+                column.append(code)
+        yield run_id, seq, epoch_seconds(finished_at), dict(columns, port=ports), new_strings
+
+def export_chunks(first_run=None, last_run=None):
+    """
+    Streams completed runs with ids in [first_run, last_run] (all if None)
+    in the format above, one bytes chunk per run.
+    """
+    # Like api.stream_ndjson, this may be resumed on different threads.
+    conn = connect(check_same_thread=False)
+    try:
+        yield MAGIC
+        for run_id, seq, finished_at, columns, new_strings in encoded_runs(conn, first_run, last_run):
+            payload = zlib.compress(
+                b''.join(encode_strings(new_strings[name]) for name in DICTIONARIES)
+                + b''.join(little_endian(columns[name]) for name in ('port',) + DICTIONARIES),
+                COMPRESSION_LEVEL)
+            yield RUN_HEADER.pack(run_id, seq or 0, finished_at, len(columns['port']), len(payload)) + payload
+    finally:
+        conn.close()
+
+def export_to_file(path, first_run=None, last_run=None):
+    """Writes the export to path and returns the number of bytes written."""
+    size = 0
+    with open(path, 'wb') as f:
+        for chunk in export_chunks(first_run, last_run):
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+def export_parquet(path, first_run=None, last_run=None):
+    """
+    Writes the same history as Parquet, one row group per run, with
+    dictionary-encoded string columns. Needs pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow).")
+    string_dictionary = pa.dictionary(pa.uint32(), pa.string())
+    schema = pa.schema([('run_id', pa.uint32()), ('seq', pa.uint32()), ('finished_at', pa.float64()),
+                        ('port', pa.uint16())] + [(name, string_dictionary) for name in DICTIONARIES])
+    # Parquet can't store a null in the dictionary, so code 0 is a placeholder and NULLs are null indices.
+    dictionaries = {name: [''] for name in DICTIONARIES}
+    no_code = pa.scalar(None, pa.uint32())
+    conn = connect(check_same_thread=False)
+    try:
+        with pq.ParquetWriter(path, schema) as writer:
+            for run_id, seq, finished_at, columns, new_strings in encoded_runs(conn, first_run, last_run):
+                rows = len(columns['port'])
+                arrays = [pa.array([run_id] * rows, pa.uint32()), pa.array([seq or 0] * rows, pa.uint32()),
+                          pa.array([finished_at] * rows, pa.float64()), pa.array(columns['port'], pa.uint16())]
+                for name in DICTIONARIES:
+                    dictionaries[name].extend(new_strings[name])
+                    codes = pa.array(columns[name], pa.uint32())
+                    codes = pc.if_else(pc.equal(codes, 0), no_code, codes)
+                    arrays.append(pa.DictionaryArray.from_arrays(codes, pa.array(dictionaries[name], pa.string())))
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        conn.close()
+
+def read_strings(payload, offset):
+    (count,) = struct.unpack_from('<I', payload, offset)
+    offset += 4
+    values = []
+    for _ in range(count):
+        (length,) = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        values.append(payload[offset:offset + length].decode())
+        offset += length
+    return values, offset
+
+def load_export(source):
+    """
+    Reads an export (a path or binary file) into NumPy arrays: one entry
+    per row in 'run', 'port' and each of DICTIONARIES (codes), per-run
+    arrays under 'runs', and the code -> string lists under 'dictionaries'.
+    """
+    import numpy as np
+    f = open(source, 'rb') if isinstance(source, str) else source
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a NetworkMonitor scan export.")
+        dictionaries = {name: [None] for name in DICTIONARIES}
+        runs = {'run_id': [], 'seq': [], 'finished_at': [], 'rows': []}
+        columns = {name: [] for name in ('port',) + DICTIONARIES}
+        while header := f.read(RUN_HEADER.size):
+            run_id, seq, finished_at, rows, length = RUN_HEADER.unpack(header)
+            payload = zlib.decompress(f.read(length))
+            offset = 0
+            for name in DICTIONARIES:
+                values, offset = read_strings(payload, offset)
+                dictionaries[name].extend(values)
+            columns['port'].append(np.frombuffer(payload, '<u2', rows, offset))
+            offset += 2 * rows
+            for name in DICTIONARIES:
+                columns[name].append(np.frombuffer(payload, '<u4', rows, offset))
+                offset += 4 * rows
+            for key, value in zip(runs, (run_id, seq, finished_at, rows)):
+                runs[key].append(value)
+    finally:
+        if f is not source:
+            f.close()
+    history = {name: np.concatenate(parts) if parts else np.zeros(0, 'u4') for name, parts in columns.items()}
+    history['runs'] = {key: np.array(values) for key, values in runs.items()}
+    history['run'] = np.repeat(np.arange(len(runs['rows'])), runs['rows'])
+    history['dictionaries'] = dictionaries
+    return history
+
+def code_for(history, name, value):
+    try:
+        return history['dictionaries'][name].index(value)
+    except ValueError:
+        return -1
+
+def open_per_run(history, mask):
+    """Rows matching mask with state 'open', counted per run."""
+    import numpy as np
+    mask &= history['state'] == code_for(history, 'state', 'open')
+    return np.bincount(history['run'][mask], minlength=len(history['runs']['rows']))
+
+def host_timeseries(history, host):
+    """Open ports on host in each exported run, with the runs' finish times."""
+    counts = open_per_run(history, history['host'] == code_for(history, 'host', host))
+    return {'run_id': history['runs']['run_id'], 'finished_at': history['runs']['finished_at'], 'open_ports': counts}
+
+def port_timeseries(history, port):
+    """Hosts with port open in each exported run, with the runs' finish times."""
+    counts = open_per_run(history, history['port'] == port)
+    return {'run_id': history['runs']['run_id'], 'finished_at': history['runs']['finished_at'], 'hosts': counts}
+
+def to_dataframe(history):
+    """The history as a pandas DataFrame with categorical string columns (no per-row strings are built)."""
+    import numpy as np
+    import pandas as pd
+    data = {
+        'run_id': history['runs']['run_id'][history['run']],
+        'finished_at': pd.to_datetime(history['runs']['finished_at'][history['run']], unit='s', utc=True),
+        'port': history['port'],
+    }
+    for name in DICTIONARIES:
+        # Code 0 (NULL) becomes -1, which pandas reads as missing.
+        data[name] = pd.Categorical.from_codes(history[name].astype(np.int64) - 1,
+                                               categories=history['dictionaries'][name][1:])
+    return pd.DataFrame(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export completed scan runs for offline analysis.')
+    parser.add_argument('output')
+    parser.add_argument('--first-run', type=int)
+    parser.add_argument('--last-run', type=int)
+    parser.add_argument('--format', choices=['nmscan', 'parquet'], default='nmscan')
+    args = parser.parse_args()
+    if args.format == 'parquet':
+        export_parquet(args.output, args.first_run, args.last_run)
+    else:
+        export_to_file(args.output, args.first_run, args.last_run)
+    print(f"Exported runs to {args.output}.")
@@ -1,50 +1,101 @@
-from fastapi import FastAPI, BackgroundTasks
-from apscheduler.schedulers.background import BackgroundScheduler
-from scanner import scan_network
-from anomaly_detector import detect_anomalies
-from summarizer import summarize_anomalies
-from database import insert_summary, get_latest_summary
+import os
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from scan_jobs import submit_scan, get_job, enable_profiling, get_profile
+from dashboard import get_dashboard
+from adaptive_scheduler import ADAPTIVE_SCANNING, CHECK_TICK_SECONDS, run_due_checks, schedule_status
+import metrics
 
 app = FastAPI()
 
-# Function to perform scan and summarization
+# Queue a scan and summarization; skipped if one is already queued or running
 def perform_scan_and_summarize():
     try:
-        print("Performing scan and summarizing...")
-        scan_network()
-        anomalies = detect_anomalies()
-        summary = summarize_anomalies(anomalies)
-        insert_summary(summary)
-        print(f"Scan and summary completed: {summary}")
+        job, created = submit_scan(trigger='schedule')
+        if created:
+            print(f"Queued scheduled scan job {job['job_id']}.")
+        else:
+            print(f"Scan job {job['job_id']} already {job['status']}; skipping scheduled scan.")
     except Exception as e:
-        print(f"Error during scan and summarization: {e}")
+        print(f"Error queueing scheduled scan: {e}")
 
-# Automated scan every hour
-scheduler = BackgroundScheduler()
-scheduler.add_job(perform_scan_and_summarize, 'interval', hours=1)
+# Full scans of the whole range. With adaptive checks catching changes in
+# between, they only need to run daily.
+FULL_SCAN_INTERVAL_HOURS = float(os.getenv('FULL_SCAN_INTERVAL_HOURS', '24' if ADAPTIVE_SCANNING else '1'))
+
+# Created on startup so importing this module stays cheap
+scheduler = None
 
 @app.on_event("startup")
 async def startup_event():
+    global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(perform_scan_and_summarize, 'interval', hours=FULL_SCAN_INTERVAL_HOURS)
+    if ADAPTIVE_SCANNING:
+        scheduler.add_job(run_due_checks, 'interval', seconds=CHECK_TICK_SECONDS, max_instances=1)
     scheduler.start()
-    print("Scheduler started for hourly scans.")
+    print(f"Scheduler started: full scans every {FULL_SCAN_INTERVAL_HOURS:g}h"
+          + (", adaptive checks in between." if ADAPTIVE_SCANNING else "."))
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    scheduler.shutdown()
+    if scheduler:
+        scheduler.shutdown()
     print("Scheduler stopped.")
 
 # API Endpoints
-@app.post("/scan")
-async def trigger_scan(background_tasks: BackgroundTasks):
-    background_tasks.add_task(perform_scan_and_summarize)
-    return {"message": "Scan started. Check the summary later."}
+@app.post("/scan", status_code=202)
+def trigger_scan(profile: bool = False):
+    job, created = submit_scan(trigger='api', profile=profile)
+    message = "Scan started." if created else "A scan of this network is already in progress."
+    return {"message": f"{message} Poll /jobs/{job['job_id']} for progress.", "job": job}
+
+@app.get("/jobs/{job_id}")
+async def job_progress(job_id: int):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.post("/jobs/{job_id}/profile")
+async def profile_job(job_id: int):
+    job = enable_profiling(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No queued or running job with that id.")
+    return job
+
+@app.get("/jobs/{job_id}/profile", response_class=PlainTextResponse)
+async def job_profile(job_id: int):
+    profile = get_profile(job_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Job not found or not profiled.")
+    return profile
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/schedule")
+def get_schedule():
+    """Adaptive check targets, soonest due first."""
+    return {"adaptive": ADAPTIVE_SCANNING, "full_scan_interval_hours": FULL_SCAN_INTERVAL_HOURS,
+            "targets": schedule_status()}
 
 @app.get("/summary")
 async def get_summary():
     try:
-        summary = get_latest_summary()
+        summary = get_dashboard()["summary"]
         return {"summary": summary}
     except Exception as e:
         return {"summary": f"Error retrieving summary: {e}"}
 
+@app.get("/dashboard")
+def dashboard(request: Request):
+    snapshot = get_dashboard()
+    headers = {"ETag": snapshot["etag"], "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == snapshot["etag"]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot["body"], media_type="application/json", headers=headers)
+
 # Run with: uvicorn main:app --host 0.0.0.0 --port 8000
\ No newline at end of file
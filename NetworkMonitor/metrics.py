@@ -0,0 +1,88 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# Seconds, from a single indexed SQLite lookup up to a long nmap stage.
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+HELP = {
+    'sqlite_query_seconds': ('histogram', 'SQLite execute() time by statement and table (for SELECT, time to first row).'),
+    'scan_stage_seconds': ('histogram', 'Time spent in each scan stage.'),
+    'nmap_task_seconds': ('histogram', 'Time per nmap invocation, by kind.'),
+    'scan_rows_ingested_total': ('counter', 'Scan result rows written to the scans table.'),
+    'dashboard_requests_total': ('counter', 'Dashboard snapshot reads by result.'),
+    'voice_commands_rejected_total': ('counter', 'Voice commands turned away because the worker pool was full.'),
+    'adaptive_checks_total': ('counter', 'Adaptive shard and host checks by result.'),
+    'adaptive_rescans_total': ('counter', 'Pipeline scans asked for by adaptive checks, queued or deferred.'),
+}
+
+lock = threading.Lock()
+# name -> {label tuple: value}
+counters = {}
+# name -> {label tuple: [bucket counts..., +Inf count, sum, count]}
+histograms = {}
+# Callables returning [(name, type, help, [(labels dict, value)])], read at scrape time.
+collectors = []
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = label_key(labels)
+    with lock:
+        series = counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = label_key(labels)
+    with lock:
+        series = histograms.setdefault(name, {})
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * (len(BUCKETS) + 3)
+        values[bisect.bisect_left(BUCKETS, seconds)] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+@contextmanager
+def timed(name, **labels):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+def format_labels(key):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}' if key else ''
+
+def header(lines, name, kind, text):
+    lines.append(f"# HELP {name} {text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+def render():
+    """All metrics in the Prometheus text format."""
+    with lock:
+        counter_copy = {name: dict(series) for name, series in counters.items()}
+        histogram_copy = {name: {key: list(values) for key, values in series.items()}
+                          for name, series in histograms.items()}
+    lines = []
+    for name, series in sorted(counter_copy.items()):
+        header(lines, name, 'counter', HELP.get(name, ('', name))[1])
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{format_labels(key)} {value:g}")
+    for name, series in sorted(histogram_copy.items()):
+        header(lines, name, 'histogram', HELP.get(name, ('', name))[1])
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(list(BUCKETS) + ['+Inf'], values[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(key)} {values[-2]:.6f}")
+            lines.append(f"{name}_count{format_labels(key)} {values[-1]}")
+    for collector in collectors:
+        for name, kind, text, samples in collector():
+            header(lines, name, kind, text)
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(label_key(labels))} {value:g}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,55 @@
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter
+
+# Seconds between stack samples while a profile is running.
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.01'))
+
+def frame_stack(frame):
+    """Root-first 'file:function' entries for a frame and its callers."""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+def sample_loop(profile):
+    own_ident = threading.get_ident()
+    while not profile['stop'].wait(profile['interval']):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, '')
+            if ident != own_ident and name.startswith(profile['thread_prefixes']):
+                profile['stacks'][f"{name.rstrip('_0123456789')};{frame_stack(frame)}"] += 1
+        profile['samples'] += 1
+
+def start_profiler(thread_prefixes, interval=SAMPLE_INTERVAL):
+    """
+    Starts sampling the stacks of threads whose names start with any of
+    thread_prefixes every `interval` seconds, on a background thread.
+    Returns the profile to pass to stop_profiler/folded_stacks.
+    """
+    profile = {
+        'thread_prefixes': tuple(thread_prefixes),
+        'interval': interval,
+        'stacks': Counter(),
+        'samples': 0,
+        'started': perf_counter(),
+        'elapsed': None,
+        'stop': threading.Event(),
+    }
+    profile['thread'] = threading.Thread(target=sample_loop, args=(profile,), name='profiler', daemon=True)
+    profile['thread'].start()
+    return profile
+
+def stop_profiler(profile):
+    profile['stop'].set()
+    profile['thread'].join()
+    profile['elapsed'] = perf_counter() - profile['started']
+
+def folded_stacks(profile):
+    """Samples in the collapsed-stack format read by flamegraph.pl and speedscope."""
+    return ''.join(f"{stack} {count}\n" for stack, count in profile['stacks'].most_common())
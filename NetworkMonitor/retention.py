@@ -0,0 +1,101 @@
+import os
+from datetime import datetime
+from database import get_connection
+
+# Completed runs kept in full in scans. Older runs are folded into
+# scan_intervals. Baseline updates read the latest two runs, so at least
+# two are always kept.
+RETENTION_FULL_RUNS = max(2, int(os.getenv('RETENTION_FULL_RUNS', '168')))
+# Free pages handed back to the filesystem per incremental_vacuum step,
+# so no single step holds the write lock for long.
+VACUUM_PAGES_PER_STEP = 2000
+
+# Intervals that ended at the previous run and still match this run get
+# extended; everything else in the run starts a new interval.
+EXTEND_INTERVALS = '''
+    UPDATE scan_intervals SET last_seq = :seq
+    WHERE last_seq = :seq - 1
+      AND EXISTS (SELECT 1 FROM scans AS cur
+                  WHERE cur.run_id = :run_id AND cur.host = scan_intervals.host AND cur.port = scan_intervals.port
+                    AND cur.state IS scan_intervals.state AND cur.service IS scan_intervals.service
+                    AND cur.version IS scan_intervals.version)
+'''
+START_INTERVALS = '''
+    INSERT INTO scan_intervals (host, port, state, service, version, first_seq, last_seq)
+    SELECT cur.host, cur.port, cur.state, cur.service, cur.version, :seq, :seq
+    FROM scans AS cur
+    WHERE cur.run_id = :run_id
+      AND NOT EXISTS (SELECT 1 FROM scan_intervals AS i
+                      WHERE i.last_seq = :seq AND i.host = cur.host AND i.port = cur.port)
+'''
+
+def database_size():
+    """Bytes used by the database file and its WAL."""
+    conn = get_connection()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    wal_path = conn.execute('PRAGMA database_list').fetchone()[2] + '-wal'
+    wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    return page_size * page_count + wal_size
+
+def ensure_incremental_vacuum():
+    """
+    Switches databases created before auto_vacuum=INCREMENTAL was set.
+    That needs one full VACUUM, which rewrites the whole file.
+    """
+    conn = get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    print("Enabling incremental vacuum (one-time full VACUUM)...")
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+
+def compact_run(run_id, seq):
+    """Moves one completed run's rows from scans into scan_intervals."""
+    conn = get_connection()
+    params = {'run_id': run_id, 'seq': seq}
+    with conn:
+        conn.execute(EXTEND_INTERVALS, params)
+        conn.execute(START_INTERVALS, params)
+        conn.execute('DELETE FROM scans WHERE run_id = ?', (run_id,))
+        conn.execute('UPDATE scan_runs SET compacted_at = ? WHERE id = ?', (datetime.now(), run_id))
+
+def reclaim_space():
+    """Returns free pages to the filesystem a step at a time."""
+    conn = get_connection()
+    while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})').fetchall()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+def compact_history():
+    """
+    Compacts completed runs that have fallen out of the last
+    RETENTION_FULL_RUNS, oldest first, one transaction per run. Failed
+    runs outside the window are dropped from scans; they are never used
+    for comparisons. Returns the number of runs compacted.
+    """
+    conn = get_connection()
+    ensure_incremental_vacuum()
+    latest_seq = conn.execute('SELECT MAX(seq) FROM scan_runs').fetchone()[0]
+    if latest_seq is None:
+        return 0
+    cutoff = latest_seq - RETENTION_FULL_RUNS
+    pending = conn.execute('''
+        SELECT id, seq FROM scan_runs
+        WHERE status = 'complete' AND compacted_at IS NULL AND seq <= ?
+        ORDER BY seq
+    ''', (cutoff,)).fetchall()
+    for run_id, seq in pending:
+        compact_run(run_id, seq)
+
+    oldest_kept = conn.execute('SELECT MIN(id) FROM scan_runs WHERE seq > ?', (cutoff,)).fetchone()[0]
+    if oldest_kept is not None:
+        with conn:
+            conn.execute('''
+                DELETE FROM scans WHERE run_id IN (
+                    SELECT id FROM scan_runs WHERE status = 'failed' AND id < ?)
+            ''', (oldest_kept,))
+    reclaim_space()
+    if pending:
+        print(f"Compacted {len(pending)} runs; database is now {database_size() / 1e6:.1f} MB.")
+    return len(pending)
@@ -0,0 +1,176 @@
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import time, perf_counter
+from scanner import scan_network, get_local_network_range, DEFAULT_SCAN_MODE
+from anomaly_detector import detect_anomalies
+from summarizer import summarize_anomalies
+from database import insert_summary
+from retention import compact_history
+from dashboard import refresh_dashboard
+from profiler import start_profiler, stop_profiler, folded_stacks
+import metrics
+
+# Jobs run one at a time on a single worker thread so scans of different
+# ranges don't compete for the network or the database write lock; other
+# ranges wait in the queue.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scan-job')
+jobs = {}
+# network_range -> job id while that range has a queued or running job.
+active_jobs = {}
+jobs_lock = threading.Lock()
+job_ids = itertools.count(1)
+# Finished jobs kept around for /jobs/{id}.
+MAX_FINISHED_JOBS = 100
+# Threads sampled when a job is profiled: the job itself and the scanner's nmap workers.
+PROFILED_THREADS = ('scan-job', 'scan-worker')
+
+def submit_scan(network_range=None, trigger='api', profile=False, mode=None):
+    """
+    Queues a scan and summary of network_range (the local network if None).
+    If that range already has a queued or running job, no new job is made.
+    mode overrides the scanner's default scan mode ('full' or 'pipeline').
+    profile=True samples the job's stacks while it runs (see enable_profiling).
+    Returns (job status dict, created).
+    """
+    if network_range is None:
+        network_range = get_local_network_range()
+    with jobs_lock:
+        job_id = active_jobs.get(network_range)
+        if job_id is not None:
+            return job_status(jobs[job_id]), False
+        job = {
+            'id': next(job_ids),
+            'network_range': network_range,
+            'trigger': trigger,
+            'mode': mode,
+            'status': 'queued',
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'summary': None,
+            'error': None,
+            'progress': {},
+            'profile_requested': profile,
+            'profile': None,
+        }
+        jobs[job['id']] = job
+        active_jobs[network_range] = job['id']
+        prune_finished_jobs()
+    executor.submit(run_job, job)
+    return job_status(job), True
+
+def run_job(job):
+    with jobs_lock:
+        job['status'] = 'running'
+        job['started_at'] = datetime.now().isoformat()
+        if job['profile_requested']:
+            job['profile'] = start_profiler(PROFILED_THREADS)
+    try:
+        scan_network(job['network_range'], mode=job['mode'] or DEFAULT_SCAN_MODE, progress=job['progress'])
+        failed_tasks = job['progress'].get('failed_tasks')
+        if failed_tasks:
+            # The run is kept out of the baseline, so detect_anomalies() would
+            # only repeat the previous run's summary.
+            job['status'] = 'failed'
+            job['error'] = f"{failed_tasks} nmap tasks failed."
+            print(f"Scan job {job['id']} failed: {job['error']}")
+        else:
+            summarize_start = perf_counter()
+            summary = summarize_anomalies(detect_anomalies())
+            insert_summary(summary)
+            metrics.observe('scan_stage_seconds', perf_counter() - summarize_start, stage='summarize')
+            refresh_dashboard()
+            job['summary'] = summary
+            job['status'] = 'complete'
+            print(f"Scan job {job['id']} finished: {summary}")
+        # Queued behind any pending scans, so compaction never runs alongside one.
+        executor.submit(run_compaction)
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        print(f"Error during scan job {job['id']}: {e}")
+    finally:
+        with jobs_lock:
+            if job['profile'] is not None:
+                stop_profiler(job['profile'])
+            job['finished_at'] = datetime.now().isoformat()
+            active_jobs.pop(job['network_range'], None)
+
+def enable_profiling(job_id):
+    """
+    Turns on the sampling profiler for one job: from the start if it is
+    still queued, or from now on if it is running. Returns the job's status
+    dict, or None if the job is unknown or already finished.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None or job['finished_at'] is not None:
+            return None
+        job['profile_requested'] = True
+        if job['status'] == 'running' and job['profile'] is None:
+            job['profile'] = start_profiler(PROFILED_THREADS)
+        return job_status(job)
+
+def get_profile(job_id):
+    """Collapsed stacks sampled for job_id so far, or None if it wasn't profiled."""
+    job = jobs.get(job_id)
+    if job is None or job['profile'] is None:
+        return None
+    return folded_stacks(job['profile'])
+
+def job_metrics():
+    statuses = [job['status'] for job in list(jobs.values())]
+    yield ('scan_jobs', 'gauge', 'Scan jobs by status; more than one queued means scans are backing up.',
+           [({'status': status}, statuses.count(status)) for status in ('queued', 'running')])
+
+metrics.collectors.append(job_metrics)
+
+def run_compaction():
+    try:
+        compact_history()
+    except Exception as e:
+        print(f"Error compacting scan history: {e}")
+
+def prune_finished_jobs():
+    finished = [job_id for job_id, job in jobs.items() if job['status'] in ('complete', 'failed')]
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del jobs[job_id]
+
+def estimate_remaining(progress):
+    """Seconds left in the current stage, extrapolated from the tasks done so far."""
+    done, total = progress.get('done'), progress.get('total')
+    if not done or total is None:
+        return None
+    elapsed = time() - progress['stage_started']
+    return round(elapsed / done * (total - done), 1)
+
+def job_status(job):
+    progress = job['progress']
+    return {
+        'job_id': job['id'],
+        'network_range': job['network_range'],
+        'trigger': job['trigger'],
+        'mode': job['mode'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'run_id': progress.get('run_id'),
+        'stage': progress.get('stage'),
+        'tasks_done': progress.get('done', 0),
+        'tasks_total': progress.get('total'),
+        'hosts_done': progress.get('hosts_done', 0),
+        'ports_found': progress.get('ports_found', 0),
+        'eta_seconds': estimate_remaining(progress) if job['status'] == 'running' else None,
+        'summary': job['summary'],
+        'error': job['error'],
+        'profiling': job['profile'] is not None,
+        'profile_samples': job['profile']['samples'] if job['profile'] else 0,
+    }
+
+def get_job(job_id):
+    """Returns the status dict for job_id, or None if it is unknown."""
+    job = jobs.get(job_id)
+    return job_status(job) if job else None
@@ -1,11 +1,84 @@
-import nmap
-import netifaces
-from ipaddress import ip_interface
-from database import insert_scan_results
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ipaddress import ip_interface, ip_network
+from database import (
+    insert_scan_results_bulk, start_scan_run, finish_scan_run, get_latest_run_id, get_run_results
+)
+from baseline import update_baseline
+import metrics
 from time import time
 
+# Sharded scan profiles: nmap timing template, size of each shard (as a
+# prefix length) and how many nmap processes run at once.
+SCAN_PROFILES = {
+    'polite': {'timing': '-T2', 'shard_prefix': 26, 'workers': 2},
+    'normal': {'timing': '-T3', 'shard_prefix': 26, 'workers': 4},
+    'aggressive': {'timing': '-T4', 'shard_prefix': 27, 'workers': 8},
+}
+DEFAULT_SCAN_PROFILE = os.getenv('SCAN_PROFILE', 'normal')
+# 'full' runs -sV over the whole range; 'pipeline' discovers hosts first and
+# only version-probes new or changed ports.
+DEFAULT_SCAN_MODE = os.getenv('SCAN_MODE', 'full')
+PORT_SWEEP_BATCH_SIZE = 16
+# Global scan budget shared by full scans and adaptive checks: at most this
+# many nmap processes at once, and this many packets per second between
+# them (0 for no limit). nmap's --max-rate is fixed when it starts, so each
+# process gets the rate divided by the number of processes running at that
+# point (itself included), or by the worker count of a scan in progress if
+# that is higher, so a scan's first worker doesn't take the whole budget.
+# A lone adaptive check gets all of it. Processes already running keep
+# their rate, so the total can briefly exceed the budget when a check
+# starts during a scan.
+MAX_NMAP_PROCESSES = int(os.getenv('SCAN_MAX_PROCESSES', '8'))
+MAX_PACKETS_PER_SECOND = int(os.getenv('SCAN_MAX_PACKETS_PER_SECOND', '4000'))
+nmap_slots = threading.BoundedSemaphore(MAX_NMAP_PROCESSES)
+budget_lock = threading.Lock()
+running_processes = 0
+planned_processes = 0
+
+@contextmanager
+def planned_nmap_processes(count):
+    """Declares that the caller runs up to `count` nmap processes at once while inside."""
+    global planned_processes
+    with budget_lock:
+        planned_processes += count
+    try:
+        yield
+    finally:
+        with budget_lock:
+            planned_processes -= count
+
+def rate_limited(arguments, processes):
+    """Adds this process's share of the packet rate when `processes` share the budget."""
+    if MAX_PACKETS_PER_SECOND <= 0:
+        return arguments
+    return f"{arguments} --max-rate {max(1, MAX_PACKETS_PER_SECOND // max(1, processes))}"
+
+def run_nmap(kind, hosts, arguments):
+    """
+    Runs one nmap invocation within the scan budget, timed under
+    nmap_task_seconds{kind}, and returns the scanner.
+    """
+    global running_processes
+    # Imported here so processes that never scan don't load python-nmap.
+    import nmap
+    nm = nmap.PortScanner()
+    with nmap_slots, metrics.timed('nmap_task_seconds', kind=kind):
+        with budget_lock:
+            running_processes += 1
+            processes = min(MAX_NMAP_PROCESSES, max(running_processes, planned_processes))
+        try:
+            nm.scan(hosts=hosts, arguments=rate_limited(arguments, processes))
+        finally:
+            with budget_lock:
+                running_processes -= 1
+    return nm
+
 def get_local_network_range():
     try:
+        import netifaces
         gateways = netifaces.gateways()
         default_gateway = gateways['default'][netifaces.AF_INET]
         interface = default_gateway[1]
@@ -21,26 +94,228 @@ def get_local_network_range():
         # Fallback to a common local range:
         return "192.168.1.0/24"
 
-def scan_network(network_range=None):
-    if network_range is None:
-        network_range = get_local_network_range()
-    print(f"Starting scan of {network_range}...")
-    start_time = time()
-
-    nm = nmap.PortScanner()
-    nm.scan(hosts=network_range, arguments='-sV')
+def split_network(network_range, shard_prefix):
+    """
+    Splits a CIDR range into sub-blocks of /shard_prefix.
+    Ranges that are already small enough, or that nmap understands but
+    ipaddress doesn't (e.g. "10.0.0.1-50"), are returned as a single shard.
+    """
+    try:
+        network = ip_network(network_range, strict=False)
+    except ValueError:
+        return [network_range]
+    if network.prefixlen >= shard_prefix:
+        return [str(network)]
+    return [str(subnet) for subnet in network.subnets(new_prefix=shard_prefix)]
 
-    print(f"Found {len(nm.all_hosts())} live hosts.")
+def extract_results(nm):
+    """Returns (host, port, state, service, version) rows for every TCP port nmap reported."""
+    results = []
     for host in nm.all_hosts():
-        print(f"Scanning {host}...")
         for proto in nm[host].all_protocols():
             if proto == 'tcp':
                 for port in nm[host][proto]:
                     state = nm[host][proto][port]['state']
                     service = nm[host][proto][port]['name']
                     version = nm[host][proto][port]['version']
-                    insert_scan_results(host, port, state, service, version)
+                    results.append((host, port, state, service, version))
+    return results
+
+def scan_shard(shard, arguments):
+    nm = run_nmap('full', shard, arguments)
+    return len(nm.all_hosts()), extract_results(nm)
+
+def discover_hosts(shard, timing):
+    """Ping/ARP sweep only: returns the hosts that are up."""
+    nm = run_nmap('discovery', shard, f"-sn {timing}")
+    return [host for host in nm.all_hosts() if nm[host].state() == 'up']
+
+def sweep_ports(hosts, timing):
+    """Port sweep without version detection: returns rows with empty versions."""
+    nm = run_nmap('port_sweep', ' '.join(hosts), f"-Pn --open {timing}")
+    return extract_results(nm)
+
+def detect_versions(host, ports, timing):
+    nm = run_nmap('version_detection', host, f"-sV -Pn {timing} -p {','.join(str(port) for port in ports)}")
+    return extract_results(nm)
+
+def run_tasks(pool, fn, items, on_result):
+    """
+    Runs fn(item) for every item on the pool and calls on_result(item, result)
+    in the calling thread as each one finishes, so results are written from
+    this thread only and the sqlite connection isn't shared.
+    Returns the number of items that failed.
+    """
+    futures = {pool.submit(fn, item): item for item in items}
+    failures = 0
+    for future in as_completed(futures):
+        item = futures[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            failures += 1
+            print(f"Error scanning {item}: {e}")
+            continue
+        on_result(item, result)
+    return failures
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def start_stage(progress, stage, total):
+    """Resets the per-stage counters in a progress dict (see scan_network)."""
+    if progress is not None:
+        progress.update(stage=stage, stage_started=time(), done=0, total=total)
+
+def advance(progress, hosts=0, ports=0):
+    if progress is not None:
+        progress['done'] += 1
+        progress['hosts_done'] += hosts
+        progress['ports_found'] += ports
+
+def full_scan(pool, run_id, shards, settings, progress=None):
+    """Runs -sV over every address of every shard."""
+    arguments = f"-sV {settings['timing']}"
+    totals = {'live_hosts': 0, 'stored': 0}
+    timings = {}
+    ingest_time = 0.0
+
+    def store(shard, result):
+        nonlocal ingest_time
+        hosts, results = result
+        totals['live_hosts'] += hosts
+        ingest_start = time()
+        totals['stored'] += insert_scan_results_bulk(run_id, results)
+        ingest_time += time() - ingest_start
+        advance(progress, hosts=hosts, ports=len(results))
+        print(f"Shard {shard} done: {hosts} live hosts, {len(results)} ports.")
+
+    stage_start = time()
+    start_stage(progress, 'full_scan', len(shards))
+    failures = run_tasks(pool, lambda shard: scan_shard(shard, arguments), shards, store)
+    timings['full_scan'] = time() - stage_start - ingest_time
+    timings['ingest'] = ingest_time
+    return totals, failures, timings
+
+def pipeline_scan(pool, run_id, shards, settings, full_refresh=False, progress=None):
+    """
+    Discovery sweep, then a port sweep of live hosts only, then -sV only for
+    (host, port) pairs that are new or whose state changed since the last
+    completed run. Other pairs keep the service and version recorded then;
+    pass full_refresh=True to re-probe every open port.
+    """
+    timing = settings['timing']
+    totals = {'live_hosts': 0, 'stored': 0}
+    timings = {}
+    failures = 0
+
+    stage_start = time()
+    start_stage(progress, 'discovery', len(shards))
+    live_hosts = []
+
+    def discovered(shard, hosts):
+        live_hosts.extend(hosts)
+        advance(progress)
+
+    failures += run_tasks(pool, lambda shard: discover_hosts(shard, timing), shards, discovered)
+    totals['live_hosts'] = len(live_hosts)
+    timings['discovery'] = time() - stage_start
+    print(f"Discovery found {len(live_hosts)} live hosts.")
+
+    stage_start = time()
+    swept = []
+    batches = chunked(live_hosts, PORT_SWEEP_BATCH_SIZE)
+    start_stage(progress, 'port_sweep', len(batches))
+
+    def swept_batch(batch, results):
+        swept.extend(results)
+        advance(progress, hosts=len(batch), ports=len(results))
+
+    failures += run_tasks(pool, lambda batch: sweep_ports(batch, timing), batches, swept_batch)
+    timings['port_sweep'] = time() - stage_start
+    print(f"Port sweep found {len(swept)} open ports.")
+
+    previous_run = get_latest_run_id()
+    previous = get_run_results(previous_run) if previous_run else {}
+    unchanged = []
+    to_probe = {}
+    for host, port, state, service, version in swept:
+        known = previous.get((host, port))
+        if full_refresh or known is None or known[0] != state:
+            to_probe.setdefault(host, []).append(port)
+        else:
+            unchanged.append((host, port, state, known[1], known[2]))
+    ingest_start = time()
+    totals['stored'] += insert_scan_results_bulk(run_id, unchanged)
+    ingest_time = time() - ingest_start
+
+    stage_start = time()
+    probed_ports = sum(len(ports) for ports in to_probe.values())
+    print(f"Version detection on {probed_ports} new or changed ports ({len(unchanged)} unchanged).")
+    probe_ingest_time = 0.0
+    start_stage(progress, 'version_detection', len(to_probe))
+
+    def store(host, results):
+        nonlocal probe_ingest_time
+        ingest_start = time()
+        totals['stored'] += insert_scan_results_bulk(run_id, results)
+        probe_ingest_time += time() - ingest_start
+        advance(progress)
+
+    failures += run_tasks(pool, lambda host: detect_versions(host, to_probe[host], timing), list(to_probe), store)
+    timings['version_detection'] = time() - stage_start - probe_ingest_time
+    timings['ingest'] = ingest_time + probe_ingest_time
+    return totals, failures, timings
+
+def scan_network(network_range=None, profile=DEFAULT_SCAN_PROFILE, workers=None, mode=DEFAULT_SCAN_MODE,
+                 full_refresh=False, progress=None):
+    """
+    Scans network_range in shards, running up to `workers` nmap processes at
+    once (the profile's default if not given). mode is 'full' (-sV over the
+    whole range) or 'pipeline' (see pipeline_scan). Results are committed as
+    they come in, so a running scan is visible in the database before the
+    whole range is done.
+
+    If progress is a dict it is kept up to date while the scan runs: stage,
+    stage_started, done and total (tasks in the current stage), hosts_done,
+    ports_found, run_id and, once finished, failed_tasks.
+    """
+    if network_range is None:
+        network_range = get_local_network_range()
+    settings = SCAN_PROFILES[profile]
+    workers = workers or settings['workers']
+    shards = split_network(network_range, settings['shard_prefix'])
+    print(f"Starting {mode} scan of {network_range} ({len(shards)} shards, {workers} workers, {profile} profile)...")
+    start_time = time()
+    run_id = start_scan_run(network_range)
+    if progress is not None:
+        progress.update(run_id=run_id, hosts_done=0, ports_found=0)
+
+    try:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan-worker')
+        with planned_nmap_processes(workers), pool:
+            if mode == 'pipeline':
+                totals, failures, timings = pipeline_scan(pool, run_id, shards, settings, full_refresh, progress)
+            else:
+                totals, failures, timings = full_scan(pool, run_id, shards, settings, progress)
+    except BaseException:
+        finish_scan_run(run_id, status='failed')
+        raise
+    # A run missing results would look like hosts disappearing, so keep it out of comparisons.
+    finish_scan_run(run_id, status='failed' if failures else 'complete', stage_timings=timings)
+    if progress is not None:
+        progress['failed_tasks'] = failures
+    if not failures:
+        diff_start = time()
+        update_baseline(run_id)
+        timings['diff'] = time() - diff_start
+    for stage, seconds in timings.items():
+        metrics.observe('scan_stage_seconds', seconds, stage=stage)
 
     end_time = time()
+    print(f"Found {totals['live_hosts']} live hosts, stored {totals['stored']} results.")
+    print("Stage timings: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items()))
+    if failures:
+        print(f"{failures} nmap tasks failed; run {run_id} marked as failed.")
     print(f"Scan completed in {end_time - start_time:.2f} seconds.")
     return "Scan completed."
@@ -1,53 +1,58 @@
-def summarize_anomalies(anomalies):
+from collections import Counter
+from anomaly_detector import (
+    Change, HOST_APPEARED, HOST_DISAPPEARED, PORT_OPENED, PORT_CLOSED, SERVICE_CHANGED, VERSION_CHANGED
+)
+
+# (kind, singular, plural) in the order they are read out.
+CHANGE_LABELS = [
+    (HOST_APPEARED, "new host", "new hosts"),
+    (HOST_DISAPPEARED, "missing host", "missing hosts"),
+    (PORT_OPENED, "new open port", "new open ports"),
+    (PORT_CLOSED, "closed port", "closed ports"),
+    (SERVICE_CHANGED, "changed service", "changed services"),
+    (VERSION_CHANGED, "changed version", "changed versions"),
+]
+# Keep spoken summaries short on busy networks.
+MAX_DETAILS = 5
+
+def describe_change(change):
+    if change.port is None:
+        return change.host
+    if change.kind in (SERVICE_CHANGED, VERSION_CHANGED):
+        return f"{change.host}:{change.port} ({change.old or 'unknown'} to {change.new or 'unknown'})"
+    return f"{change.host}:{change.port}"
+
+def join_with_and(parts):
+    if len(parts) == 1:
+        return parts[0]
+    return ", ".join(parts[:-1]) + " and " + parts[-1]
+
+def summarize_anomalies(changes):
     """
-    Summarizes anomaly strings into a concise message.
-    Expects a list of strings. Possible values in anomalies:
-      - "No scans available."
-      - "No previous scan to compare."
-      - "No anomalies detected."
-      - "New host detected: x.x.x.x"
-      - "New open port p on host x.x.x.x"
+    Summarizes Change records from anomaly_detector into a concise message.
     """
-
-    # If there are no anomalies or the first message indicates no or insufficient data:
-    if (not anomalies or 
-        anomalies[0] in ["No scans available.", "No previous scan to compare.", "No anomalies detected."]):
+    if not changes:
         return "Nothing unusual found on your network."
 
-    summary = "Network changes detected: "
-    host_count = 0
-    port_count = 0
-    details = []
-
-    for anomaly in anomalies:
-        if "New host" in anomaly:
-            host_count += 1
-            details.append(anomaly.split("detected: ")[-1])
-        elif "New open port" in anomaly:
-            port_count += 1
-            details.append(anomaly.split("on host ")[-1])
-
-    # Build summary text
-    if host_count > 0:
-        summary += f"{host_count} new host{'s' if host_count > 1 else ''} "
-    if port_count > 0:
-        # Add 'and ' only if we already have host(s)
-        if host_count > 0:
-            summary += "and "
-        summary += f"{port_count} new open port{'s' if port_count > 1 else ''} "
-
-    if details:
-        summary += "found, including " + ", ".join(details) + "."
-
-    return summary.strip()
+    counts = Counter(change.kind for change in changes)
+    parts = [
+        f"{counts[kind]} {singular if counts[kind] == 1 else plural}"
+        for kind, singular, plural in CHANGE_LABELS if counts[kind]
+    ]
+
+    details = [describe_change(change) for change in changes[:MAX_DETAILS]]
+    if len(changes) > MAX_DETAILS:
+        details.append(f"{len(changes) - MAX_DETAILS} more")
+
+    return f"Network changes detected: {join_with_and(parts)} found, including {join_with_and(details)}."
 
 # Test it
 if __name__ == "__main__":
-    test_anomalies = [
-        "New host detected: 10.0.0.50",
-        "New open port 80 on host 10.0.0.44",
-        "New host detected: 10.0.0.51"
+    test_changes = [
+        Change(HOST_APPEARED, "10.0.0.50", None, None, None),
+        Change(PORT_OPENED, "10.0.0.44", 80, None, None),
+        Change(HOST_APPEARED, "10.0.0.51", None, None, None),
+        Change(VERSION_CHANGED, "10.0.0.44", 22, "OpenSSH 9.6", "OpenSSH 9.7"),
     ]
-    print(summarize_anomalies(test_anomalies))
-    print(summarize_anomalies(["No previous scan to compare."]))
-    print(summarize_anomalies(["No anomalies detected."]))
+    print(summarize_anomalies(test_changes))
+    print(summarize_anomalies([]))
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Optional
+
+from fastapi import HTTPException
+
+
+EXPIRY_CHECK_INTERVAL = 60
+MAX_BACKOFF = 300
+
+
+class AccountPool:
+    """Warm pool of pre-provisioned temporary accounts.
+
+    A background task keeps up to `size` ready accounts (anything with an
+    `expiresAt` in epoch milliseconds) queued, oldest first. `pop` hands
+    one out in O(1) and drops entries that expire within `expiry_margin`
+    seconds. Provisioning is spaced by `refill_interval` and backs off on
+    errors, honouring Retry-After when the provider rate limits us.
+    """
+
+    def __init__(
+        self,
+        provision: Callable[[], Awaitable[Any]],
+        size: int,
+        expiry_margin: float,
+        refill_interval: float,
+    ):
+        self._provision = provision
+        self.size = size
+        self.expiry_margin = expiry_margin
+        self.refill_interval = refill_interval
+        self._entries: Deque[Any] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.served = 0
+        self.empty = 0
+        self.provisioned = 0
+        self.discarded = 0
+        self.provision_errors = 0
+        self.rate_limited = 0
+
+    def start(self) -> None:
+        """Starts the background provisioner. Does nothing if the pool size is 0."""
+        if self.size <= 0 or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"Account pool started (size={self.size}).")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logging.info("Account pool stopped.")
+
+    def pop(self) -> Optional[Any]:
+        """Returns a ready account, or None if the pool has none left."""
+        self._discard_expiring()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._entries:
+            self.served += 1
+            return self._entries.popleft()
+        self.empty += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "ready": len(self._entries),
+            "served": self.served,
+            "empty": self.empty,
+            "provisioned": self.provisioned,
+            "discarded": self.discarded,
+            "provision_errors": self.provision_errors,
+            "rate_limited": self.rate_limited,
+        }
+
+    def _discard_expiring(self) -> None:
+        cutoff_ms = (time.time() + self.expiry_margin) * 1000
+        # Entries are queued in creation order, so expiring ones are at the front.
+        while self._entries and self._entries[0].expiresAt <= cutoff_ms:
+            self._entries.popleft()
+            self.discarded += 1
+
+    async def _run(self) -> None:
+        backoff = self.refill_interval
+        while True:
+            self._discard_expiring()
+            if len(self._entries) >= self.size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=EXPIRY_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                self._entries.append(await self._provision())
+                self.provisioned += 1
+                backoff = self.refill_interval
+                delay = self.refill_interval
+            except HTTPException as e:
+                self.provision_errors += 1
+                backoff = min(max(backoff, 1) * 2, MAX_BACKOFF)
+                delay = backoff
+                if e.status_code == 429:
+                    self.rate_limited += 1
+                    delay = max(delay, retry_after_seconds(e))
+                logging.warning(f"Account pool provisioning failed ({e.status_code}), retrying in {delay:.0f}s.")
+            except Exception:
+                self.provision_errors += 1
+                backoff = min(max(backoff, 1) * 2, MAX_BACKOFF)
+                delay = backoff
+                logging.exception(f"Unexpected error provisioning pooled account, retrying in {delay:.0f}s.")
+            await asyncio.sleep(delay)
+
+
+def retry_after_seconds(error: HTTPException) -> float:
+    """Reads a Retry-After header (in seconds) from an HTTPException, or 0."""
+    try:
+        return float((error.headers or {}).get("Retry-After", 0))
+    except ValueError:
+        return 0.0
@@ -0,0 +1,264 @@
+"""Load benchmark for the temp email backend.
+
+Starts the fake mail.tm stand-in and server.py as separate uvicorn processes,
+then drives /messages and /generate_email with concurrent clients and reports
+throughput, latency percentiles and the server's peak RSS. --inbox-sizes
+repeats the run with that many messages per fake inbox.
+
+To compare against another build (for example the previous commit), start
+that server yourself with MAIL_TM_BASE_URL pointing at a running
+fake_mailtm and pass --target, or save a baseline with --save-baseline and
+check later runs against it with --baseline.
+
+The fault options make the fake mail.tm fail, rate limit or stall a
+fraction of calls (see fake_mailtm.py). With --tokens, /messages requests
+spread over that many inboxes so they can't all be served from one cache
+entry. --no-resilience runs the server with retries, adaptive timeouts and
+the circuit breaker turned off, for comparison.
+
+Run with: python benchmark.py --requests 2000 --concurrency 100
+          python benchmark.py --inbox-sizes 5 50 200 --save-baseline bench.json
+          python benchmark.py --inbox-sizes 5 50 200 --baseline bench.json
+          python benchmark.py --tokens 1000 --error-rate 0.2 --slow-rate 0.05 --slow-ms 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Union
+
+import httpx
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Result fields checked against a baseline, and whether higher is better.
+BASELINE_METRICS = {"throughput": True, "p50_ms": False, "p95_ms": False, "p99_ms": False, "peak_rss_mb": False}
+# Latency changes smaller than this are noise, whatever the percentage.
+NOISE_MS = 5.0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_uvicorn(module: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=HERE,
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL,
+    )
+
+def wait_until_ready(url: str, timeout: float = 15.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not start in time.")
+
+def stop_process(process: subprocess.Popen) -> float:
+    """Stops a server started by start_uvicorn and returns its peak RSS in MB."""
+    process.terminate()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+class ThreadSampler:
+    """Polls a process's thread count in the background and keeps the peak (Linux only)."""
+
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.path = f"/proc/{pid}/status"
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        if line.startswith("Threads:"):
+                            self.peak = max(self.peak, int(line.split()[1]))
+            except OSError:
+                return
+
+    def __enter__(self) -> "ThreadSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_load(target: str, method: str, path: str, total: int, concurrency: int,
+                   headers: Union[None, dict, Callable[[int], dict]] = None) -> dict:
+    """Sends `total` requests from `concurrency` workers. headers may be a function of the request number."""
+    latencies: List[float] = []
+    errors = 0
+    statuses: Dict[str, int] = {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60.0) as client:
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                i = queue.get_nowait()
+                start = time.perf_counter()
+                try:
+                    res = await client.request(method, path, headers=headers(i) if callable(headers) else headers)
+                    status = str(res.status_code)
+                    if res.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                    errors += 1
+                statuses[status] = statuses.get(status, 0) + 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "endpoint": f"{method} {path}",
+        "requests": total,
+        "errors": errors,
+        "statuses": statuses,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+def print_result(result: dict) -> None:
+    print(
+        f"{result['endpoint']:<22} {result.get('inbox_size', '-'):>6} msgs {result['requests']:>7} req  "
+        f"{result['errors']:>5} err  {result['throughput']:>9.1f} req/s  p50 {result['p50_ms']:>8.1f} ms  "
+        f"p95 {result['p95_ms']:>8.1f} ms  p99 {result['p99_ms']:>8.1f} ms"
+        + (f"  RSS {result['peak_rss_mb']:>6.0f} MB" if "peak_rss_mb" in result else "")
+        + (f"  threads {result['peak_threads']}" if result.get("peak_threads") else "")
+    )
+    if set(result["statuses"]) - {"200"}:
+        print(f"{'':<22} statuses: {dict(sorted(result['statuses'].items()))}")
+
+def compare_to_baseline(results: List[dict], baseline: List[dict], tolerance: float) -> bool:
+    """Prints every metric worse than the baseline by more than tolerance; returns True if there are none."""
+    previous: Dict[tuple, dict] = {(entry["endpoint"], entry.get("inbox_size")): entry for entry in baseline}
+    ok = True
+    for result in results:
+        old = previous.get((result["endpoint"], result.get("inbox_size")))
+        if old is None:
+            continue
+        for metric, higher_is_better in BASELINE_METRICS.items():
+            if not old.get(metric) or metric not in result:
+                continue
+            if metric.endswith("_ms") and abs(result[metric] - old[metric]) < NOISE_MS:
+                continue
+            change = result[metric] / old[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                ok = False
+                print(f"REGRESSION {result['endpoint']} ({result.get('inbox_size')} msgs) {metric}: "
+                      f"{old[metric]:.1f} -> {result[metric]:.1f} ({change:+.0%})")
+    if ok:
+        print(f"No regressions beyond {tolerance:.0%} of the baseline.")
+    return ok
+
+def run_suite(target: str, requests: int, concurrency: int, tokens: int = 1) -> List[dict]:
+    return [
+        asyncio.run(run_load(target, "GET", "/messages", requests, concurrency,
+                             headers=lambda i: {"Authorization": f"Bearer bench-token-{i % tokens}"})),
+        asyncio.run(run_load(target, "POST", "/generate_email", max(1, requests // 10), concurrency)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=80, help="Simulated mail.tm round trip.")
+    parser.add_argument("--target", help="Benchmark an already running server instead of starting one.")
+    parser.add_argument("--inbox-sizes", type=int, nargs="+", default=[5],
+                        help="Messages per fake inbox; the servers are restarted for each size.")
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against results saved with --save-baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before failing.")
+    parser.add_argument("--tokens", type=int, default=1, help="Distinct inboxes /messages requests are spread over.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of upstream calls failing with 503.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Fraction of upstream calls getting 429.")
+    parser.add_argument("--slow-rate", type=float, default=0, help="Fraction of upstream calls stalling.")
+    parser.add_argument("--slow-ms", type=float, default=20000, help="How long a stalled upstream call takes.")
+    parser.add_argument("--no-resilience", action="store_true", help="Turn off retries and the circuit breaker.")
+    args = parser.parse_args()
+
+    results: List[dict] = []
+    if args.target:
+        print(f"Benchmarking {args.target} ({args.requests} requests, concurrency {args.concurrency})")
+        results = run_suite(args.target, args.requests, args.concurrency, args.tokens)
+        for result in results:
+            print_result(result)
+
+    for inbox_size in [] if args.target else args.inbox_sizes:
+        upstream = server = None
+        try:
+            upstream_port, server_port = free_port(), free_port()
+            upstream = start_uvicorn("fake_mailtm:app", upstream_port, {
+                "FAKE_MAILTM_LATENCY_MS": str(args.latency_ms),
+                "FAKE_MAILTM_MESSAGES": str(inbox_size),
+                "FAKE_MAILTM_ERROR_RATE": str(args.error_rate),
+                "FAKE_MAILTM_RATE_LIMIT_RATE": str(args.rate_limit_rate),
+                "FAKE_MAILTM_SLOW_RATE": str(args.slow_rate),
+                "FAKE_MAILTM_SLOW_MS": str(args.slow_ms),
+            })
+            wait_until_ready(f"http://127.0.0.1:{upstream_port}/domains")
+            server = start_uvicorn("server:app", server_port, {
+                "MAIL_TM_BASE_URL": f"http://127.0.0.1:{upstream_port}",
+                "MAIL_TM_RESILIENCE": "0" if args.no_resilience else "1",
+            })
+            target = f"http://127.0.0.1:{server_port}"
+            wait_until_ready(f"{target}/")
+            with ThreadSampler(server.pid) as threads:
+                size_results = run_suite(target, args.requests, args.concurrency, args.tokens)
+        finally:
+            peak_rss = stop_process(server) if server else 0.0
+            if upstream:
+                stop_process(upstream)
+        for result in size_results:
+            result.update(inbox_size=inbox_size, peak_rss_mb=peak_rss, peak_threads=threads.peak)
+            print_result(result)
+        results.extend(size_results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare_to_baseline(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class DomainCache:
+    """Process-wide cache for the mail.tm domain.
+
+    A value younger than `ttl` is served as a hit. Between `ttl` and
+    `ttl + stale_ttl` the old value is still served while one background
+    refresh runs. Past that, or when empty, callers wait on the refresh.
+    Concurrent refreshes are collapsed into a single upstream fetch.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[str]], ttl: float, stale_ttl: float):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._value: Optional[str] = None
+        self._fetched_at = 0.0
+        self._inflight: Optional[asyncio.Future] = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def get(self, force_refresh: bool = False) -> str:
+        """Returns the cached domain, fetching it from the provider if needed."""
+        if self._value is not None and not force_refresh:
+            age = time.monotonic() - self._fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return self._value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._start_refresh()
+                return self._value
+
+        self.misses += 1
+        # Shield so one cancelled caller doesn't cancel the fetch other callers share.
+        return await asyncio.shield(self._start_refresh())
+
+    def invalidate(self, domain: Optional[str] = None) -> None:
+        """Drops the cached domain, or only `domain` if given and still cached."""
+        if domain is None or domain == self._value:
+            logging.info(f"Invalidating cached domain: {self._value}")
+            self._value = None
+            self._fetched_at = 0.0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "domain": self._value,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "hit_rate": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+        }
+
+    def _start_refresh(self) -> asyncio.Future:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._refresh())
+            self._inflight.add_done_callback(self._log_failure)
+        return self._inflight
+
+    async def _refresh(self) -> str:
+        self.refreshes += 1
+        try:
+            value = await self._fetch()
+        except Exception:
+            self.refresh_errors += 1
+            raise
+        self._value = value
+        self._fetched_at = time.monotonic()
+        return value
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        # Retrieving the exception here also keeps background refresh
+        # failures from being reported as "never retrieved".
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning(f"Domain refresh failed: {future.exception()}")
@@ -0,0 +1,109 @@
+"""Local stand-in for the mail.tm API, used by benchmark.py.
+
+Implements just enough of /domains, /accounts, /token and /messages for
+server.py to run against it. Every response is delayed by
+FAKE_MAILTM_LATENCY_MS to mimic the round trip to the real provider.
+
+Faults can be injected into a fraction of responses, from the environment
+at startup or at runtime with POST /_faults (same keys, lowercase, without
+the prefix):
+  FAKE_MAILTM_ERROR_RATE       503 Service Unavailable
+  FAKE_MAILTM_RATE_LIMIT_RATE  429 with Retry-After: FAKE_MAILTM_RETRY_AFTER
+  FAKE_MAILTM_SLOW_RATE        an extra FAKE_MAILTM_SLOW_MS of latency
+
+Run with: uvicorn fake_mailtm:app --port 8100
+"""
+import asyncio
+import os
+import random
+import string
+import time
+from typing import Dict, Optional
+
+from fastapi import FastAPI, Header, HTTPException
+
+
+LATENCY_MS = float(os.getenv("FAKE_MAILTM_LATENCY_MS", "80"))
+MESSAGES_PER_INBOX = int(os.getenv("FAKE_MAILTM_MESSAGES", "5"))
+DOMAIN = "fortress-bench.test"
+faults: Dict[str, float] = {
+    "error_rate": float(os.getenv("FAKE_MAILTM_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("FAKE_MAILTM_RATE_LIMIT_RATE", "0")),
+    "retry_after": float(os.getenv("FAKE_MAILTM_RETRY_AFTER", "1")),
+    "slow_rate": float(os.getenv("FAKE_MAILTM_SLOW_RATE", "0")),
+    "slow_ms": float(os.getenv("FAKE_MAILTM_SLOW_MS", "20000")),
+}
+
+app = FastAPI(title="Fake mail.tm")
+
+accounts: Dict[str, str] = {}
+tokens: Dict[str, str] = {}
+
+
+def random_string(length=10):
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+
+async def simulate_latency():
+    """Waits out the simulated round trip, then fails or stalls if a fault is injected."""
+    await asyncio.sleep(LATENCY_MS / 1000)
+    roll = random.random()
+    if roll < faults["error_rate"]:
+        raise HTTPException(status_code=503, detail="Injected fault.")
+    roll -= faults["error_rate"]
+    if roll < faults["rate_limit_rate"]:
+        raise HTTPException(status_code=429, detail="Injected rate limit.",
+                            headers={"Retry-After": f"{faults['retry_after']:g}"})
+    if random.random() < faults["slow_rate"]:
+        await asyncio.sleep(faults["slow_ms"] / 1000)
+
+def fake_message(address: str, index: int) -> dict:
+    return {
+        "id": f"{address}-{index}",
+        "from": {"address": f"sender{index}@example.com"},
+        "subject": f"Message {index}",
+        "createdAt": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1700000000 + index)),
+        "seen": False,
+        "intro": "Lorem ipsum dolor sit amet " * 4,
+    }
+
+
+@app.post("/_faults")
+async def set_faults(payload: Dict[str, float]):
+    """Changes the injected faults; unknown keys are rejected."""
+    unknown = set(payload) - set(faults)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fault settings: {sorted(unknown)}")
+    faults.update(payload)
+    return faults
+
+@app.get("/domains")
+async def domains():
+    await simulate_latency()
+    return {"hydra:member": [{"id": "1", "domain": DOMAIN, "isActive": True}]}
+
+@app.post("/accounts", status_code=201)
+async def create_account(payload: dict):
+    await simulate_latency()
+    address = payload.get("address", "")
+    if not address.endswith(f"@{DOMAIN}"):
+        raise HTTPException(status_code=422, detail="This value is not a valid domain.")
+    accounts[address] = payload.get("password", "")
+    return {"id": random_string(), "address": address}
+
+@app.post("/token")
+async def create_token(payload: dict):
+    await simulate_latency()
+    address = payload.get("address", "")
+    if accounts.get(address) != payload.get("password"):
+        raise HTTPException(status_code=401, detail="Invalid credentials.")
+    token = random_string(32)
+    tokens[token] = address
+    return {"id": random_string(), "token": token}
+
+@app.get("/messages")
+async def messages(authorization: Optional[str] = Header(None)):
+    await simulate_latency()
+    token = (authorization or "").replace("Bearer ", "")
+    # Unknown tokens still get an inbox so load tests can use arbitrary tokens.
+    address = tokens.get(token, f"bench@{DOMAIN}")
+    return {"hydra:member": [fake_message(address, i) for i in range(MESSAGES_PER_INBOX)]}
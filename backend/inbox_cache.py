@@ -0,0 +1,97 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+
+class CachedInbox:
+    """One token's inbox, keyed by message id, with its rendered response body."""
+
+    def __init__(self, messages: Dict[str, Any], etag: str, body: bytes, cursor: Optional[str]):
+        self.messages = messages
+        self.etag = etag
+        self.body = body
+        self.cursor = cursor
+        self.fetched_at = time.monotonic()
+
+    def since(self, cursor: str) -> List[Any]:
+        """Messages received after `cursor` (a receivedAt timestamp), newest first."""
+        return [message for message in self.messages.values() if message.receivedAt > cursor]
+
+
+class InboxCache:
+    """LRU cache of inboxes across tokens.
+
+    The ETag is derived from message ids and read flags only, so an unchanged
+    inbox is detected without serializing it. Its response body is rendered
+    once, when the inbox changes, and reused until the next change. Entries
+    younger than `freshness` seconds are served without an upstream fetch.
+    """
+
+    def __init__(self, render: Callable[[List[Any], Optional[str]], bytes], max_inboxes: int, freshness: float):
+        self._render = render
+        self.max_inboxes = max_inboxes
+        self.freshness = freshness
+        self._entries: "OrderedDict[str, CachedInbox]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.renders = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> Optional[CachedInbox]:
+        """Returns the cached inbox if it is fresh enough to serve as is."""
+        entry = self._entries.get(token)
+        if entry is None or time.monotonic() - entry.fetched_at >= self.freshness:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry
+
+    def update(self, token: str, messages: List[Any]) -> CachedInbox:
+        """Stores a freshly fetched inbox, re-rendering only if it changed."""
+        etag = inbox_etag(messages)
+        entry = self._entries.get(token)
+        if entry is not None and entry.etag == etag:
+            entry.fetched_at = time.monotonic()
+            self._entries.move_to_end(token)
+            return entry
+
+        cursor = max((message.receivedAt for message in messages), default=None)
+        self.renders += 1
+        entry = CachedInbox(
+            {message.id: message for message in messages},
+            etag,
+            self._render(messages, cursor),
+            cursor,
+        )
+        self._entries[token] = entry
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_inboxes:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def record_not_modified(self) -> None:
+        self.not_modified += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "inboxes": len(self._entries),
+            "max_inboxes": self.max_inboxes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "not_modified": self.not_modified,
+            "renders": self.renders,
+            "evictions": self.evictions,
+        }
+
+
+def inbox_etag(messages: List[Any]) -> str:
+    digest = hashlib.sha1()
+    for message in messages:
+        digest.update(f"{message.id}:{int(message.read)};".encode())
+    return f'"{digest.hexdigest()}"'
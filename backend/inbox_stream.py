@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+
+class _Inbox:
+    def __init__(self):
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.seen_ids: Set[str] = set()
+        self.snapshot: Optional[list] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class InboxHub:
+    """Shares upstream inbox fetches between every client of the same token.
+
+    `fetch` collapses concurrent fetches for one token into a single upstream
+    call. `subscribe` attaches a queue to the token's inbox; while it has
+    subscribers, one poller per inbox fetches every `poll_interval` seconds
+    and pushes only messages it has not seen before.
+
+    Subscribers receive dict events: {"type": "snapshot", "messages": [...]}
+    first, then {"type": "new", "messages": [...]} as mail arrives, or a
+    final {"type": "error", "status": ..., "detail": ...}. An inbox whose
+    token is rejected is dropped, so later subscribers poll it afresh.
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[List[Any]]], poll_interval: float):
+        self._fetch = fetch
+        self.poll_interval = poll_interval
+        self._inboxes: Dict[str, _Inbox] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.upstream_fetches = 0
+        self.coalesced_fetches = 0
+        self.messages_pushed = 0
+
+    async def fetch(self, token: str) -> List[Any]:
+        """Fetches the inbox for `token`, joining an in-flight fetch if there is one."""
+        future = self._inflight.get(token)
+        if future is None:
+            self.upstream_fetches += 1
+            future = asyncio.ensure_future(self._fetch(token))
+            self._inflight[token] = future
+            future.add_done_callback(lambda f, t=token: self._forget_fetch(t, f))
+        else:
+            self.coalesced_fetches += 1
+        return await asyncio.shield(future)
+
+    def subscribe(self, token: str) -> asyncio.Queue:
+        """Returns a queue of inbox events for `token`, starting its poller if needed."""
+        inbox = self._inboxes.get(token)
+        if inbox is None:
+            inbox = self._inboxes[token] = _Inbox()
+            inbox.task = asyncio.create_task(self._poll(token, inbox))
+        queue: asyncio.Queue = asyncio.Queue()
+        if inbox.snapshot is not None:
+            queue.put_nowait({"type": "snapshot", "messages": inbox.snapshot})
+        inbox.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, token: str, queue: asyncio.Queue) -> None:
+        """Detaches `queue`, stopping the poller once an inbox has no subscribers."""
+        inbox = self._inboxes.get(token)
+        # The inbox may have been dropped (see _poll) and replaced since `queue` subscribed.
+        if inbox is None or queue not in inbox.subscribers:
+            return
+        inbox.subscribers.discard(queue)
+        if not inbox.subscribers:
+            inbox.task.cancel()
+            del self._inboxes[token]
+
+    def stats(self) -> dict:
+        return {
+            "active_inboxes": len(self._inboxes),
+            "subscribers": sum(len(inbox.subscribers) for inbox in self._inboxes.values()),
+            "upstream_fetches": self.upstream_fetches,
+            "coalesced_fetches": self.coalesced_fetches,
+            "messages_pushed": self.messages_pushed,
+        }
+
+    def _forget_fetch(self, token: str, future: asyncio.Future) -> None:
+        if self._inflight.get(token) is future:
+            del self._inflight[token]
+        if not future.cancelled():
+            future.exception()
+
+    async def _poll(self, token: str, inbox: _Inbox) -> None:
+        while True:
+            try:
+                messages = await self.fetch(token)
+            except HTTPException as e:
+                if e.status_code == 401:
+                    # Detached first so a client subscribing from now on starts a new
+                    # poller and gets its own answer, instead of waiting on this one.
+                    if self._inboxes.get(token) is inbox:
+                        del self._inboxes[token]
+                    self._publish(inbox, {"type": "error", "status": e.status_code, "detail": e.detail})
+                    return
+                logging.warning(f"Inbox poll failed ({e.status_code}), retrying in {self.poll_interval}s.")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            except Exception as e:
+                logging.exception("Unexpected error polling inbox")
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if inbox.snapshot is None:
+                # Serialized once here and shared by every subscriber.
+                inbox.snapshot = jsonable_encoder(messages)
+                inbox.seen_ids = {message.id for message in messages}
+                self._publish(inbox, {"type": "snapshot", "messages": inbox.snapshot})
+            else:
+                new_messages = [message for message in messages if message.id not in inbox.seen_ids]
+                if new_messages:
+                    encoded = jsonable_encoder(new_messages)
+                    inbox.seen_ids.update(message.id for message in new_messages)
+                    inbox.snapshot = encoded + inbox.snapshot
+                    self._publish(inbox, {"type": "new", "messages": encoded})
+            await asyncio.sleep(self.poll_interval)
+
+    def _publish(self, inbox: _Inbox, event: dict) -> None:
+        self.messages_pushed += len(event.get("messages", ())) * len(inbox.subscribers)
+        for queue in inbox.subscribers:
+            queue.put_nowait(event)
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+
+from metrics import registry
+from resilience import AdaptiveTimeout, CircuitBreaker, ProviderUnavailableError, backoff_delay, parse_retry_after
+
+
+MAX_CONNECTIONS = int(os.getenv("MAIL_TM_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("MAIL_TM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+MAX_CONCURRENCY = int(os.getenv("MAIL_TM_MAX_CONCURRENCY", "20"))
+KEEPALIVE_EXPIRY = 30
+# Set to 0 for a fixed timeout and a single attempt per call, with no circuit breaker.
+RESILIENCE = os.getenv("MAIL_TM_RESILIENCE", "1") == "1"
+MIN_TIMEOUT = float(os.getenv("MAIL_TM_MIN_TIMEOUT", "1"))
+MAX_ATTEMPTS = int(os.getenv("MAIL_TM_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("MAIL_TM_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("MAIL_TM_BREAKER_RESET", "30"))
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUSES = {502, 503, 504}
+
+registry.describe("mailtm_request_seconds", "histogram", "Upstream mail.tm request latency.")
+registry.describe("mailtm_pool_wait_seconds", "histogram", "Time spent waiting for a free upstream request slot.")
+registry.describe("mailtm_pool_saturated_total", "counter", "Upstream requests that found every slot busy.")
+registry.describe("mailtm_retries_total", "counter", "Upstream calls retried, by endpoint and reason.")
+registry.describe("mailtm_fast_failures_total", "counter", "Upstream calls refused without contacting mail.tm.")
+
+
+def endpoint_label(path: str) -> str:
+    """First path segment, so /messages/{id} and /messages share a label."""
+    return "/" + path.lstrip("/").split("/", 1)[0].split("?", 1)[0]
+
+
+class MailTmClient:
+    """Shared async HTTP client for mail.tm.
+
+    Keeps a pool of keep-alive connections open to the provider and caps the
+    number of upstream requests in flight, so a burst of inbox polls queues
+    here instead of opening a fresh TCP/TLS connection per call.
+
+    `timeout` bounds the whole call, including waiting for a slot and any
+    retries. Within it each attempt gets a per-endpoint timeout that
+    follows observed latency, idempotent calls are retried with jittered
+    backoff on timeouts, connection errors and 502/503/504 (and on 429
+    once its Retry-After has passed, if that fits), and a circuit breaker
+    refuses calls with ProviderUnavailableError while the provider is down
+    or has asked us to back off.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float,
+        max_connections: int = MAX_CONNECTIONS,
+        max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+        max_concurrency: int = MAX_CONCURRENCY,
+        resilient: bool = RESILIENCE,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_concurrency = max_concurrency
+        self.resilient = resilient
+        self.max_attempts = MAX_ATTEMPTS if resilient else 1
+        self.timeouts = AdaptiveTimeout(min(MIN_TIMEOUT, timeout), timeout)
+        # Without resilience the breaker only keeps counts; it never opens.
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD if resilient else float("inf"), BREAKER_RESET_TIMEOUT)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+
+    async def start(self) -> None:
+        """Opens the connection pool. Safe to call more than once."""
+        if self._client is not None:
+            return
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=limits,
+            headers={"Accept": "application/json"},
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        logging.info(
+            f"Mail provider client started (connections={self.max_connections}, "
+            f"concurrency={self.max_concurrency})."
+        )
+
+    async def close(self) -> None:
+        """Closes the connection pool."""
+        if self._client is None:
+            return
+        await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+        logging.info("Mail provider client closed.")
+
+    async def request(self, method: str, path: str, idempotent: Optional[bool] = None, **kwargs) -> httpx.Response:
+        """Sends a request through the shared pool, retrying it if it is idempotent.
+
+        Methods other than GET/HEAD/OPTIONS are sent once unless the caller
+        passes idempotent=True. Returns the last response, or raises the
+        last error if no attempt got one.
+        """
+        if self._client is None:
+            await self.start()
+        endpoint = endpoint_label(path)
+        retryable = idempotent if idempotent is not None else method in IDEMPOTENT_METHODS
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        while True:
+            if self.resilient:
+                try:
+                    self.breaker.before_request()
+                except ProviderUnavailableError as e:
+                    registry.inc("mailtm_fast_failures_total", reason="rate_limited" if e.rate_limited else "circuit_open")
+                    raise
+            res: Optional[httpx.Response] = None
+            error: Optional[httpx.HTTPError] = None
+            delay: Optional[float] = None
+            try:
+                # The adaptive timeout only pays off if a timed-out attempt can be retried; an
+                # attempt that can't be gets the whole budget rather than failing a slow success.
+                retry_allowed = retryable and attempt + 1 < self.max_attempts
+                res = await self._send(method, path, endpoint, deadline - time.monotonic(), retry_allowed, **kwargs)
+            except httpx.TimeoutException as e:
+                error, reason = e, "timeout"
+                self.timeouts.timed_out(endpoint)
+                self.breaker.record_failure()
+            except httpx.TransportError as e:
+                error, reason = e, "connection"
+                self.breaker.record_failure()
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                reason = str(res.status_code)
+                if res.status_code == 429:
+                    delay = parse_retry_after(res.headers.get("Retry-After"))
+                    if delay:
+                        self.breaker.record_retry_after(delay)
+                    else:
+                        self.breaker.release_probe()
+                elif res.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if res.status_code not in RETRY_STATUSES and (res.status_code != 429 or delay is None):
+                    return res
+
+            attempt += 1
+            if delay is None:
+                delay = backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY)
+            # Only retry if the next attempt could still get its minimum timeout.
+            if not retryable or attempt >= self.max_attempts or time.monotonic() + delay + self.timeouts.minimum > deadline:
+                if res is not None:
+                    return res
+                raise error
+            registry.inc("mailtm_retries_total", endpoint=endpoint, reason=reason)
+            logging.info(f"Retrying {method} {endpoint} in {delay:.2f}s after {reason} (attempt {attempt}).")
+            await asyncio.sleep(delay)
+
+    async def _send(
+        self, method: str, path: str, endpoint: str, remaining: float, adaptive: bool = True, **kwargs
+    ) -> httpx.Response:
+        """One attempt: waits up to `remaining` seconds for a slot, then sends.
+
+        The request gets the endpoint's adaptive timeout if `adaptive` is set,
+        otherwise whatever is left of `remaining`.
+        """
+        if self._semaphore.locked():
+            registry.inc("mailtm_pool_saturated_total")
+        wait_start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(remaining, 0.001))
+        except asyncio.TimeoutError:
+            registry.inc("mailtm_fast_failures_total", reason="pool_exhausted")
+            raise ProviderUnavailableError("Every mail provider request slot stayed busy.", 1.0)
+        waited = time.perf_counter() - wait_start
+        registry.observe("mailtm_pool_wait_seconds", waited)
+        timeout = self.timeouts.get(endpoint) if self.resilient and adaptive else self.timeout
+        timeout = max(0.001, min(timeout, remaining - waited))
+        self.in_flight += 1
+        try:
+            with registry.timer("mailtm_request_seconds", method=method, endpoint=endpoint, status="error") as labels:
+                start = time.perf_counter()
+                try:
+                    res = await self._client.request(method, path, timeout=timeout, **kwargs)
+                except httpx.HTTPError as e:
+                    labels["status"] = type(e).__name__
+                    raise
+                labels["status"] = res.status_code
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+        if res.status_code < 500:
+            self.timeouts.observe(endpoint, time.perf_counter() - start)
+        return res
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "circuit": self.breaker.stats(),
+            "timeouts": self.timeouts.stats(),
+        }
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
@@ -0,0 +1,176 @@
+import email.utils
+import logging
+import random
+import time
+from typing import Dict, Optional
+
+import httpx
+
+
+class ProviderUnavailableError(httpx.HTTPError):
+    """Raised instead of calling mail.tm while the circuit is open or a Retry-After is in force."""
+
+    def __init__(self, message: str, retry_after: float, rate_limited: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.rate_limited = rate_limited
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveTimeout:
+    """Per-endpoint request timeout that follows observed latency.
+
+    Uses the TCP retransmission timer's estimator: a smoothed latency plus
+    four times its smoothed deviation, clamped to [minimum, maximum]. A
+    timeout doubles the endpoint's value so a slow provider isn't cut off
+    repeatedly. Endpoints with no samples yet get `maximum`.
+    """
+
+    def __init__(self, minimum: float, maximum: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._smoothed: Dict[str, float] = {}
+        self._deviation: Dict[str, float] = {}
+        self._timeouts: Dict[str, float] = {}
+
+    def get(self, endpoint: str) -> float:
+        return self._timeouts.get(endpoint, self.maximum)
+
+    def observe(self, endpoint: str, seconds: float) -> None:
+        smoothed = self._smoothed.get(endpoint)
+        if smoothed is None:
+            smoothed, deviation = seconds, seconds / 2
+        else:
+            deviation = 0.75 * self._deviation[endpoint] + 0.25 * abs(smoothed - seconds)
+            smoothed = 0.875 * smoothed + 0.125 * seconds
+        self._smoothed[endpoint] = smoothed
+        self._deviation[endpoint] = deviation
+        self._timeouts[endpoint] = min(self.maximum, max(self.minimum, smoothed + 4 * deviation))
+
+    def timed_out(self, endpoint: str) -> None:
+        self._timeouts[endpoint] = min(self.maximum, self.get(endpoint) * 2)
+
+    def stats(self) -> Dict[str, float]:
+        return dict(self._timeouts)
+
+
+class CircuitBreaker:
+    """Fails calls to the provider fast while it is down or rate limiting us.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    every call is refused for `reset_timeout` seconds. Then a single probe
+    is let through: success closes the circuit, failure opens it again. A
+    429 with Retry-After blocks calls until then without counting as a
+    failure, since the provider is up but asked us to wait.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: float, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._rate_limited_until = 0.0
+        self._probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+
+    def before_request(self) -> None:
+        """Raises ProviderUnavailableError if a call shouldn't go out now."""
+        now = time.monotonic()
+        if now < self._rate_limited_until:
+            self.rejected += 1
+            raise ProviderUnavailableError(
+                "Mail provider asked us to back off.", self._rate_limited_until - now, rate_limited=True
+            )
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise ProviderUnavailableError(
+                    "Mail provider is unavailable.", self._opened_at + self.reset_timeout - now
+                )
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise ProviderUnavailableError("Mail provider is unavailable.", 1.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logging.info("Mail provider recovered; closing circuit.")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logging.warning(f"Mail provider failing; opening circuit for {self.reset_timeout:.0f}s.")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def record_retry_after(self, seconds: float) -> None:
+        self._probe_in_flight = False
+        self._rate_limited_until = max(self._rate_limited_until, time.monotonic() + seconds)
+
+    def release_probe(self) -> None:
+        """Lets another probe through if this one ended without a result (e.g. it was cancelled)."""
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "rate_limited_for": max(0.0, self._rate_limited_until - time.monotonic()),
+        }
+
+
+class TokenBucket:
+    """Admits `rate` operations per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self.rejected = 0
+
+    def try_acquire(self) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        self.rejected += 1
+        return (1 - self._tokens) / self.rate
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst, "tokens": self._tokens, "rejected": self.rejected}
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
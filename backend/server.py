@@ -1,4 +1,6 @@
-import requests
+import asyncio
+import json
+import math
 import time
 import random
 import string
@@ -6,10 +8,21 @@ import logging
 import os
 from typing import List, Optional, Dict, Any
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field 
 from dotenv import load_dotenv
+import httpx
+
+from account_pool import AccountPool
+from domain_cache import DomainCache
+from inbox_cache import InboxCache
+from inbox_stream import InboxHub
+from mail_client import MailTmClient
+from metrics import registry
+from resilience import ProviderUnavailableError, TokenBucket
 
 
 load_dotenv() 
@@ -20,6 +33,23 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 BASE_URL = os.getenv("MAIL_TM_BASE_URL", "https://api.mail.tm")
 REQUEST_TIMEOUT = 15 
+DOMAIN_CACHE_TTL = float(os.getenv("DOMAIN_CACHE_TTL", "600"))
+DOMAIN_CACHE_STALE_TTL = float(os.getenv("DOMAIN_CACHE_STALE_TTL", "3600"))
+ACCOUNT_TTL = 3600
+ACCOUNT_POOL_SIZE = int(os.getenv("ACCOUNT_POOL_SIZE", "3"))
+ACCOUNT_POOL_EXPIRY_MARGIN = float(os.getenv("ACCOUNT_POOL_EXPIRY_MARGIN", "600"))
+ACCOUNT_POOL_REFILL_INTERVAL = float(os.getenv("ACCOUNT_POOL_REFILL_INTERVAL", "2"))
+INBOX_POLL_INTERVAL = float(os.getenv("INBOX_POLL_INTERVAL", "10"))
+INBOX_CACHE_MAX_INBOXES = int(os.getenv("INBOX_CACHE_MAX_INBOXES", "1000"))
+INBOX_CACHE_FRESHNESS = float(os.getenv("INBOX_CACHE_FRESHNESS", "10"))
+# New accounts per second /generate_email may create upstream once the pool
+# is empty, with bursts up to GENERATE_EMAIL_BURST; beyond that callers get
+# a 429 with Retry-After instead of queueing behind mail.tm's own limit.
+GENERATE_EMAIL_RATE = float(os.getenv("GENERATE_EMAIL_RATE", "2"))
+GENERATE_EMAIL_BURST = float(os.getenv("GENERATE_EMAIL_BURST", "5"))
+
+mail_client = MailTmClient(BASE_URL, REQUEST_TIMEOUT)
+generate_email_bucket = TokenBucket(GENERATE_EMAIL_RATE, GENERATE_EMAIL_BURST)
 
 
 class Message(BaseModel):
@@ -37,20 +67,45 @@ class GenerateEmailResponse(BaseModel):
 
 class MessagesResponse(BaseModel):
     messages: List[Message]
+    cursor: Optional[str] = None
 
 class ErrorDetail(BaseModel):
     detail: str
 
 
+class DomainRejectedError(HTTPException):
+    """Raised when mail.tm refuses to create an account on the given domain."""
+
+
 def random_string(length=10):
     """Generates a random string."""
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
-def get_domain() -> str:
-    """Fetches the first available domain from mail.tm (Synchronous)."""
+def rate_limited_error(res: httpx.Response) -> HTTPException:
+    """Builds a 429 that carries the provider's Retry-After header through."""
+    headers = {"Retry-After": res.headers["Retry-After"]} if "Retry-After" in res.headers else None
+    return HTTPException(status_code=429, detail="Mail provider rate limit reached. Please try again later.", headers=headers)
+
+def connection_error(e: httpx.HTTPError, endpoint: str) -> HTTPException:
+    """Maps a failed provider call to a 503, or a 429 while mail.tm has asked us to back off.
+
+    Calls refused by the circuit breaker carry a Retry-After for when the
+    provider will be tried again.
+    """
+    if isinstance(e, ProviderUnavailableError):
+        headers = {"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        if e.rate_limited:
+            return HTTPException(status_code=429, detail="Mail provider rate limit reached. Please try again later.",
+                                 headers=headers)
+        return HTTPException(status_code=503, detail=f"Mail provider {endpoint} endpoint is unavailable: {e}",
+                             headers=headers)
+    return HTTPException(status_code=503, detail=f"Failed to connect to mail provider {endpoint} endpoint: {e}")
+
+async def get_domain() -> str:
+    """Fetches the first available domain from mail.tm."""
     logging.info("Attempting to get domain...")
     try:
-        res = requests.get(f"{BASE_URL}/domains", timeout=REQUEST_TIMEOUT)
+        res = await mail_client.get("/domains")
         res.raise_for_status() 
         data = res.json()
         domains = data.get("hydra:member", [])
@@ -61,15 +116,19 @@ def get_domain() -> str:
         else:
             logging.warning("No domains found or unexpected format from API.")
             raise HTTPException(status_code=503, detail="Could not retrieve a valid domain from mail provider.")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Error getting domain: {e}")
-        raise HTTPException(status_code=503, detail=f"Failed to connect to mail provider domains endpoint: {e}")
+        raise connection_error(e, "domains")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Unexpected error getting domain: {e}")
         raise HTTPException(status_code=500, detail="An internal error occurred while fetching domains.")
 
-def create_account(domain: str) -> tuple[str, str]:
-    """Creates a mail.tm account (Synchronous)."""
+domain_cache = DomainCache(get_domain, ttl=DOMAIN_CACHE_TTL, stale_ttl=DOMAIN_CACHE_STALE_TTL)
+
+async def create_account(domain: str) -> tuple[str, str]:
+    """Creates a mail.tm account."""
     username = random_string()
     email = f"{username}@{domain}"
     password = "TempPass_" + random_string(8) + "!" 
@@ -77,11 +136,14 @@ def create_account(domain: str) -> tuple[str, str]:
 
     try:
         payload = {"address": email, "password": password}
-        res = requests.post(f"{BASE_URL}/accounts", json=payload, timeout=REQUEST_TIMEOUT)
+        res = await mail_client.post("/accounts", json=payload)
 
         if res.status_code == 201:
             logging.info(f"Account created successfully: {email}")
             return email, password
+        elif res.status_code == 429:
+            logging.warning(f"Account creation for {email} was rate limited by mail provider.")
+            raise rate_limited_error(res)
         else:
             logging.error(f"Account creation failed for {email}. Status: {res.status_code}, Response: {res.text}")
             detail_msg = f"Mail provider account creation failed (Status {res.status_code})."
@@ -93,21 +155,26 @@ def create_account(domain: str) -> tuple[str, str]:
                      detail_msg = f"Mail provider error: {error_data['detail']}"
             except Exception:
                 pass 
+            if res.status_code == 422:
+                raise DomainRejectedError(status_code=502, detail=detail_msg)
             raise HTTPException(status_code=502, detail=detail_msg)
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Error creating account {email}: {e}")
-        raise HTTPException(status_code=503, detail=f"Failed to connect to mail provider accounts endpoint: {e}")
+        raise connection_error(e, "accounts")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Unexpected error creating account {email}: {e}")
         raise HTTPException(status_code=500, detail="An internal error occurred during account creation.")
 
-def get_token(email: str, password: str) -> str:
-    """Authenticates with mail.tm and gets a JWT token (Synchronous)."""
+async def get_token(email: str, password: str) -> str:
+    """Authenticates with mail.tm and gets a JWT token."""
     logging.info(f"Attempting to get token for: {email}")
     try:
         payload = {"address": email, "password": password}
-        res = requests.post(f"{BASE_URL}/token", json=payload, timeout=REQUEST_TIMEOUT)
+        # Asking for a token again has no side effects, so it may be retried.
+        res = await mail_client.post("/token", json=payload, idempotent=True)
 
         if res.status_code == 200:
             data = res.json()
@@ -121,23 +188,28 @@ def get_token(email: str, password: str) -> str:
         elif res.status_code == 401:
              logging.warning(f"Token retrieval failed for {email} (Unauthorized). Status: {res.status_code}, Response: {res.text}")
              raise HTTPException(status_code=401, detail="Mail provider authentication failed (Invalid credentials?).")
+        elif res.status_code == 429:
+            logging.warning(f"Token retrieval for {email} was rate limited by mail provider.")
+            raise rate_limited_error(res)
         else:
             logging.error(f"Token retrieval failed for {email}. Status: {res.status_code}, Response: {res.text}")
             raise HTTPException(status_code=502, detail=f"Mail provider authentication failed (Status {res.status_code}).")
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Error getting token for {email}: {e}")
-        raise HTTPException(status_code=503, detail=f"Failed to connect to mail provider token endpoint: {e}")
+        raise connection_error(e, "token")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Unexpected error getting token for {email}: {e}")
         raise HTTPException(status_code=500, detail="An internal error occurred during token retrieval.")
 
-def fetch_messages_from_provider(token: str) -> List[Message]:
-    """Fetches messages from mail.tm using the token (Synchronous)."""
+async def fetch_messages_from_provider(token: str) -> List[Message]:
+    """Fetches messages from mail.tm using the token."""
     logging.info("Attempting to fetch messages from provider...")
     headers = {"Authorization": f"Bearer {token}"}
     try:
-        res = requests.get(f"{BASE_URL}/messages", headers=headers, timeout=REQUEST_TIMEOUT)
+        res = await mail_client.get("/messages", headers=headers)
 
         if res.status_code == 200:
             data = res.json()
@@ -166,13 +238,56 @@ def fetch_messages_from_provider(token: str) -> List[Message]:
             logging.error(f"Error fetching messages from provider. Status: {res.status_code}, Response: {res.text}")
             raise HTTPException(status_code=502, detail=f"Failed to fetch messages from mail provider (Status {res.status_code}).")
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Error fetching messages from provider: {e}")
-        raise HTTPException(status_code=503, detail=f"Failed to connect to mail provider messages endpoint: {e}")
+        raise connection_error(e, "messages")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Unexpected error fetching messages: {e}")
         raise HTTPException(status_code=500, detail="An internal error occurred while fetching messages.")
 
+async def provision_account() -> GenerateEmailResponse:
+    """Runs the domain -> account -> token sequence for a brand new email."""
+    domain = await domain_cache.get()
+    try:
+        email, password = await create_account(domain)
+    except DomainRejectedError:
+        logging.warning(f"Domain {domain} was rejected by mail provider, refreshing domain cache.")
+        domain_cache.invalidate(domain)
+        domain = await domain_cache.get()
+        email, password = await create_account(domain)
+    token = await get_token(email, password)
+
+    expires_at_ms = int((time.time() + ACCOUNT_TTL) * 1000)
+
+    logging.info(f"Successfully generated email: {email}")
+    return GenerateEmailResponse(
+        email=email,
+        token=token,
+        expiresAt=expires_at_ms
+    )
+
+account_pool = AccountPool(
+    provision_account,
+    size=ACCOUNT_POOL_SIZE,
+    expiry_margin=ACCOUNT_POOL_EXPIRY_MARGIN,
+    refill_interval=ACCOUNT_POOL_REFILL_INTERVAL,
+)
+
+def render_messages(messages: List[Message], cursor: Optional[str]) -> bytes:
+    return json.dumps(jsonable_encoder(MessagesResponse(messages=messages, cursor=cursor))).encode()
+
+inbox_cache = InboxCache(render_messages, max_inboxes=INBOX_CACHE_MAX_INBOXES, freshness=INBOX_CACHE_FRESHNESS)
+
+async def fetch_and_cache_messages(token: str) -> List[Message]:
+    """Fetches an inbox from the provider and refreshes its cache entry."""
+    messages = await fetch_messages_from_provider(token)
+    inbox_cache.update(token, messages)
+    return messages
+
+inbox_hub = InboxHub(fetch_and_cache_messages, poll_interval=INBOX_POLL_INTERVAL)
+
 app = FastAPI(
     title="Temp Email API Proxy",
     description="Proxies requests to mail.tm for temporary email generation and retrieval.",
@@ -184,42 +299,116 @@ app.add_middleware(
     allow_origins=["*"], 
     allow_credentials=True,
     allow_methods=["GET", "POST"],
-    allow_headers=["Authorization", "Content-Type"],
+    allow_headers=["Authorization", "Content-Type", "If-None-Match"],
+    expose_headers=["ETag"],
 )
 
+registry.describe("http_request_seconds", "histogram", "Time to handle each request, by route.")
+
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        registry.observe(
+            "http_request_seconds", time.perf_counter() - start,
+            method=request.method, route=route.path if route else "unmatched", status=status,
+        )
+
+def cache_metrics():
+    """Exports the caches' and pools' own stats counters at scrape time."""
+    sources = [
+        ("domain_cache", domain_cache.stats(), ["hits", "stale_hits", "misses", "refreshes", "refresh_errors"], []),
+        ("account_pool", account_pool.stats(),
+         ["served", "empty", "provisioned", "discarded", "provision_errors", "rate_limited"], ["size", "ready"]),
+        ("inbox_hub", inbox_hub.stats(), ["upstream_fetches", "coalesced_fetches", "messages_pushed"],
+         ["active_inboxes", "subscribers"]),
+        ("inbox_cache", inbox_cache.stats(), ["hits", "misses", "not_modified", "renders", "evictions"],
+         ["inboxes", "max_inboxes"]),
+        ("mailtm_pool", mail_client.stats(), [], ["in_flight", "max_concurrency"]),
+        ("mailtm_circuit", mail_client.breaker.stats(), ["opened", "rejected"],
+         ["consecutive_failures", "rate_limited_for"]),
+        ("generate_email_bucket", generate_email_bucket.stats(), ["rejected"], ["tokens"]),
+    ]
+    for prefix, stats, counters, gauges in sources:
+        if counters:
+            yield (f"{prefix}_events_total", "counter", f"{prefix} events by kind.",
+                   [({"event": name}, stats[name]) for name in counters])
+        for name in gauges:
+            yield (f"{prefix}_{name}", "gauge", f"Current {prefix} {name.replace('_', ' ')}.", [({}, stats[name])])
+    circuit_state = mail_client.breaker.state
+    yield ("mailtm_circuit_open", "gauge", "1 while calls to mail.tm are refused, 0.5 while probing.",
+           [({}, {"closed": 0, "half_open": 0.5, "open": 1}[circuit_state])])
+    yield ("mailtm_timeout_seconds", "gauge", "Current adaptive timeout per mail.tm endpoint.",
+           [({"endpoint": endpoint}, seconds) for endpoint, seconds in mail_client.timeouts.stats().items()])
+
+registry.add_collector(cache_metrics)
+
+
+@app.on_event("startup")
+async def startup_event():
+    await mail_client.start()
+    account_pool.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await account_pool.stop()
+    await mail_client.close()
+
 
 @app.get("/")
 def read_root(): 
     """Root endpoint to check if the server is running."""
     return {"message": "Temporary Email Backend is running!"}
 
+@app.get("/stats", summary="Cache Statistics")
+def read_stats():
+    """Reports hit/miss counters for the server-side caches."""
+    return {
+        "domain_cache": domain_cache.stats(),
+        "account_pool": account_pool.stats(),
+        "inbox_hub": inbox_hub.stats(),
+        "inbox_cache": inbox_cache.stats(),
+        "mail_provider": mail_client.stats(),
+        "generate_email_bucket": generate_email_bucket.stats(),
+    }
+
+@app.get("/metrics", summary="Prometheus Metrics", response_class=PlainTextResponse)
+def read_metrics():
+    """Latency histograms and counters in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post(
     "/generate_email",
     response_model=GenerateEmailResponse,
     summary="Generate Temporary Email",
     description="Creates a new temporary email account via mail.tm and returns credentials.",
     responses={
+        429: {"model": ErrorDetail, "description": "Too Many Requests (Mail Provider or Local Rate Limit)"},
         500: {"model": ErrorDetail, "description": "Internal Server Error"},
         502: {"model": ErrorDetail, "description": "Bad Gateway (Mail Provider Error)"},
         503: {"model": ErrorDetail, "description": "Service Unavailable (Mail Provider Connection Error)"}
     }
 )
-def handle_generate_email(): 
+async def handle_generate_email(): 
     """Generates a new temporary email address, password, and token."""
     logging.info("Received request for /generate_email")
     try:
-        domain = get_domain()
-        email, password = create_account(domain)
-        token = get_token(email, password)
-
-        expires_at_ms = int((time.time() + 3600) * 1000)
-
-        logging.info(f"Successfully generated email: {email}")
-        return GenerateEmailResponse(
-            email=email,
-            token=token,
-            expiresAt=expires_at_ms
-        )
+        account = account_pool.pop()
+        if account is not None:
+            logging.info(f"Served pooled email: {account.email}")
+            return account
+        wait = generate_email_bucket.try_acquire()
+        if wait > 0:
+            logging.warning("Rejecting /generate_email: account creation rate limit reached.")
+            raise HTTPException(status_code=429, detail="Too many new email requests. Please try again later.",
+                                headers={"Retry-After": str(max(1, math.ceil(wait)))})
+        return await provision_account()
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -230,15 +419,24 @@ def handle_generate_email():
     "/messages",
     response_model=MessagesResponse,
     summary="Fetch Inbox Messages",
-    description="Retrieves messages for the temporary email account using the provided token.",
+    description=(
+        "Retrieves messages for the temporary email account using the provided token. "
+        "Send the last ETag in If-None-Match to get a 304 when nothing changed, or the last "
+        "cursor as `since` to get only messages received after it."
+    ),
      responses={
+        304: {"description": "Not Modified (Inbox unchanged since the given ETag)"},
         401: {"model": ErrorDetail, "description": "Unauthorized (Invalid/Expired Token)"},
         500: {"model": ErrorDetail, "description": "Internal Server Error"},
         502: {"model": ErrorDetail, "description": "Bad Gateway (Mail Provider Error)"},
         503: {"model": ErrorDetail, "description": "Service Unavailable (Mail Provider Connection Error)"}
     }
 )
-def handle_get_messages(authorization: Optional[str] = Header(None)): 
+async def handle_get_messages(
+    authorization: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    since: Optional[str] = Query(None, description="Cursor from a previous response."),
+):
     """Fetches messages using the Bearer token from the Authorization header."""
     if not authorization or not authorization.startswith("Bearer "):
         logging.warning("Missing or invalid Authorization header in /messages request.")
@@ -252,14 +450,70 @@ def handle_get_messages(authorization: Optional[str] = Header(None)):
     logging.info(f"Received request for /messages with token prefix: {token[:5]}...")
 
     try:
-        messages = fetch_messages_from_provider(token)
-        return MessagesResponse(messages=messages)
+        inbox = inbox_cache.get(token)
+        if inbox is None:
+            inbox = inbox_cache.update(token, await inbox_hub.fetch(token))
+
+        headers = {"ETag": inbox.etag}
+        if if_none_match == inbox.etag:
+            inbox_cache.record_not_modified()
+            return Response(status_code=304, headers=headers)
+        if since:
+            body = render_messages(inbox.since(since), inbox.cursor or since)
+            return Response(content=body, media_type="application/json", headers=headers)
+        return Response(content=inbox.body, media_type="application/json", headers=headers)
     except HTTPException as e:
         raise e
     except Exception as e:
         logging.exception("Unhandled exception in /messages")
         raise HTTPException(status_code=500, detail=f"An unexpected internal error occurred while fetching messages: {e}")
 
+@app.websocket("/messages/stream")
+async def stream_messages(websocket: WebSocket, token: Optional[str] = None):
+    """Pushes inbox updates for a token: a snapshot first, then only new messages.
+
+    The token comes from the Authorization header, or the `token` query
+    parameter for clients that cannot set WebSocket headers.
+    """
+    authorization = websocket.headers.get("authorization")
+    if authorization and authorization.startswith("Bearer "):
+        token = authorization.split(" ")[1]
+    if not token:
+        logging.warning("Missing token in /messages/stream request.")
+        await websocket.close(code=1008)
+        return
+
+    await websocket.accept()
+    logging.info(f"Inbox stream opened for token prefix: {token[:5]}...")
+    queue = inbox_hub.subscribe(token)
+    # The client never sends anything; this only completes when it disconnects.
+    disconnected = asyncio.ensure_future(wait_for_disconnect(websocket))
+    try:
+        while True:
+            next_event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                next_event.cancel()
+                break
+            event = next_event.result()
+            await websocket.send_json(event)
+            if event["type"] == "error":
+                await websocket.close(code=1008)
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        disconnected.cancel()
+        inbox_hub.unsubscribe(token, queue)
+        logging.info(f"Inbox stream closed for token prefix: {token[:5]}...")
+
+async def wait_for_disconnect(websocket: WebSocket) -> None:
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+
 if __name__ == "__main__":
     import uvicorn
     logging.info("Starting Uvicorn server directly (use 'uvicorn server:app --reload' for development)...")
@@ -18,7 +18,7 @@ import {
 import { StatusBar } from "expo-status-bar"
 import * as Speech from "expo-speech"
 import { Mic, MicOff } from "lucide-react-native"
-import { triggerScan, getLatestSummary, getSummaries } from "../services/network-scan-api"
+import { triggerScan, waitForScanJob, getDashboard, getLatestSummary, getSummaries } from "../services/network-scan-api"
 
 const formatTimestamp = (timestampStr) => {
   if (!timestampStr) return "N/A"
@@ -54,7 +54,6 @@ export default function NetworkScannerScreen({ navigation }) {
   const pulseAnim = useRef(new Animated.Value(1)).current
 
   const isMounted = useRef(true)
-  const refreshTimeout = useRef(null)
 
 
   useEffect(() => {
@@ -63,9 +62,6 @@ export default function NetworkScannerScreen({ navigation }) {
 
     return () => {
       isMounted.current = false
-      if (refreshTimeout.current) {
-        clearTimeout(refreshTimeout.current)
-      }
       if (isListening) {
         stopListening()
       }
@@ -101,10 +97,10 @@ export default function NetworkScannerScreen({ navigation }) {
       setError(null)
 
       try {
-        const [latestSummResponse, histSummResponse] = await Promise.all([getLatestSummary(), getSummaries()])
+        const [dashboard, histSummResponse] = await Promise.all([getDashboard(), getSummaries()])
 
         if (isMounted.current) {
-          setLatestSummary(latestSummResponse?.latest_summary || "Failed to load summary.")
+          setLatestSummary(dashboard?.latest_summary || "Failed to load summary.")
           setHistoricalSummaries(histSummResponse?.summaries || [])
         }
       } catch (err) {
@@ -137,12 +133,22 @@ export default function NetworkScannerScreen({ navigation }) {
         const message = response.detail || "Scan is running in the background."
         Alert.alert("Scan Started", message)
         setVoiceMessage(message)
-
-        if (refreshTimeout.current) clearTimeout(refreshTimeout.current)
-        refreshTimeout.current = setTimeout(() => {
-          console.log("Refreshing data after scan trigger delay...")
+      }
+      if (response.job) {
+        const job = await waitForScanJob(response.job.job_id, {
+          isCancelled: () => !isMounted.current,
+          onProgress: (status) => {
+            if (isMounted.current && status.status === "running") {
+              const eta = status.eta_seconds != null ? `, about ${Math.ceil(status.eta_seconds)}s left` : ""
+              setVoiceMessage(`Scanning: ${status.hosts_done} hosts, ${status.ports_found} ports found${eta}`)
+            }
+          },
+        })
+        if (isMounted.current) {
+          if (job.summary) setLatestSummary(job.summary)
+          setVoiceMessage(job.status === "complete" ? "Scan complete" : "Scan finished with errors")
           fetchData(true)
-        }, 20000)
+        }
       }
     } catch (err) {
       console.error("Error triggering scan:", err)
@@ -16,7 +16,7 @@ import {
   Platform,
 } from "react-native"
 import { StatusBar } from "expo-status-bar"
-import { generateTempEmail, fetchMessages } from "../services/mail-tm-api"
+import { generateTempEmail, fetchMessages, subscribeToMessages } from "../services/mail-tm-api"
 
 export default function TempEmailScreen({ navigation }) {
   const [tempEmail, setTempEmail] = useState(null)
@@ -29,6 +29,7 @@ export default function TempEmailScreen({ navigation }) {
   const [error, setError] = useState(null)
 
   const pollingInterval = useRef(null)
+  const unsubscribeStream = useRef(null)
   const isMounted = useRef(true)
 
 
@@ -39,6 +40,9 @@ export default function TempEmailScreen({ navigation }) {
       if (pollingInterval.current) {
         clearInterval(pollingInterval.current)
       }
+      if (unsubscribeStream.current) {
+        unsubscribeStream.current()
+      }
     }
   }, [])
 
@@ -70,6 +74,7 @@ export default function TempEmailScreen({ navigation }) {
           setExpiresAt(null)
           setMessages([])
           if (pollingInterval.current) clearInterval(pollingInterval.current)
+          if (unsubscribeStream.current) unsubscribeStream.current()
           Alert.alert("Session Expired", "Please generate a new temporary email.")
         } else {
           if (errorMessage.toLowerCase().includes("network request failed")) {
@@ -101,6 +106,37 @@ export default function TempEmailScreen({ navigation }) {
     [fetchAndUpdateMessages],
   )
 
+  // Prefer server-pushed updates; fall back to polling if the stream drops.
+  const startStreaming = useCallback(
+    (currentToken) => {
+      if (!currentToken) return
+      if (unsubscribeStream.current) unsubscribeStream.current()
+      setIsLoadingMessages(true)
+      unsubscribeStream.current = subscribeToMessages(currentToken, {
+        onMessages: (incoming, isSnapshot) => {
+          if (!isMounted.current) return
+          setIsLoadingMessages(false)
+          setError(null)
+          if (isSnapshot) {
+            setMessages(incoming)
+          } else {
+            setMessages((prev) => {
+              const known = new Set(prev.map((m) => m.id))
+              return [...incoming.filter((m) => !known.has(m.id)), ...prev]
+            })
+          }
+        },
+        // A closed stream (including a rejected token) falls back to polling,
+        // which surfaces errors through fetchAndUpdateMessages.
+        onClose: () => {
+          unsubscribeStream.current = null
+          if (isMounted.current) startPolling(currentToken)
+        },
+      })
+    },
+    [startPolling],
+  )
+
   const handleGenerateEmail = useCallback(async () => {
     setIsGenerating(true)
     setError(null)
@@ -109,6 +145,7 @@ export default function TempEmailScreen({ navigation }) {
     setToken(null)
     setExpiresAt(null)
     if (pollingInterval.current) clearInterval(pollingInterval.current)
+    if (unsubscribeStream.current) unsubscribeStream.current()
 
     try {
       const result = await generateTempEmail()
@@ -116,7 +153,7 @@ export default function TempEmailScreen({ navigation }) {
         setTempEmail(result.email)
         setToken(result.token)
         setExpiresAt(result.expiresAt)
-        startPolling(result.token)
+        startStreaming(result.token)
       }
     } catch (err) {
       console.error("[handleGenerateEmail] Error:", err)
@@ -132,7 +169,7 @@ export default function TempEmailScreen({ navigation }) {
     } finally {
       if (isMounted.current) setIsGenerating(false)
     }
-  }, [startPolling])
+  }, [startStreaming])
 
   const onRefresh = useCallback(() => {
     if (!token) {
@@ -51,6 +51,9 @@ export const generateTempEmail = async () => {
   }
 }
 
+// Last inbox seen per token, so unchanged inboxes can be revalidated with a 304.
+const inboxCache = new Map()
+
 /**
  * Fetch inbox messages from the backend server using the token.
  */
@@ -60,15 +63,25 @@ export const fetchMessages = async (token) => {
     return []
   }
   try {
+    const cached = inboxCache.get(token)
+    const headers = {
+      Authorization: `Bearer ${token}`,
+      Accept: "application/json",
+    }
+    if (cached) headers["If-None-Match"] = cached.etag
     const response = await fetch(`${BACKEND_URL}/messages`, {
       method: "GET",
-      headers: {
-        Authorization: `Bearer ${token}`,
-        Accept: "application/json",
-      },
+      headers,
     })
+    if (response.status === 304 && cached) {
+      return cached.messages
+    }
     const data = await handleResponse(response)
-    return data.messages || []
+    const messages = data.messages || []
+    const etag = response.headers.get("ETag")
+    inboxCache.clear()
+    if (etag) inboxCache.set(token, { etag, messages })
+    return messages
   } catch (error) {
     console.error("Error calling backend /messages:", error)
     // Add specific check for Network request failed
@@ -80,6 +93,47 @@ export const fetchMessages = async (token) => {
   }
 }
 
+/**
+ * Subscribe to inbox updates pushed by the backend over a WebSocket.
+ * The backend polls mail.tm once per inbox and only sends what changed:
+ * onMessages(messages, true) with the full inbox first, then
+ * onMessages(newMessages, false) as mail arrives.
+ * Returns a function that closes the subscription.
+ */
+export const subscribeToMessages = (token, { onMessages, onError, onClose }) => {
+  const streamUrl = `${BACKEND_URL.replace(/^http/, "ws")}/messages/stream`
+  const socket = new WebSocket(streamUrl, null, {
+    headers: { Authorization: `Bearer ${token}` },
+  })
+  let closedByClient = false
+
+  socket.onmessage = (event) => {
+    let data
+    try {
+      data = JSON.parse(event.data)
+    } catch (e) {
+      console.error("Failed to parse inbox stream event:", e)
+      return
+    }
+    if (data.type === "snapshot" || data.type === "new") {
+      onMessages(data.messages || [], data.type === "snapshot")
+    } else if (data.type === "error") {
+      onError && onError(new Error(data.detail || `Inbox stream error (${data.status})`))
+    }
+  }
+  socket.onerror = (event) => {
+    console.error("Inbox stream error:", event.message)
+  }
+  socket.onclose = () => {
+    if (!closedByClient && onClose) onClose()
+  }
+
+  return () => {
+    closedByClient = true
+    socket.close()
+  }
+}
+
 // Optional formatMessage function (backend handles formatting now)
 export const formatMessage = (message) => {
   return {
@@ -23,8 +23,13 @@ const handleResponse = async (response) => {
   }
 }
 
+const JOB_POLL_INTERVAL_MS = 3000
+const FINISHED_JOB_STATUSES = ["complete", "failed"]
+
 /**
- * @returns {Promise<{status: string, detail: string}>}
+ * Queues a scan. If one is already running for the network, the server
+ * returns that job instead of starting another.
+ * @returns {Promise<{status: string, detail: string, job: object}>}
  */
 export const triggerScan = async () => {
   try {
@@ -41,6 +46,7 @@ export const triggerScan = async () => {
     return {
       status: data.status || "success",
       detail: data.message || "Scan started successfully.",
+      job: data.job,
     }
   } catch (error) {
     console.error("Error triggering scan:", error)
@@ -48,6 +54,56 @@ export const triggerScan = async () => {
   }
 }
 
+/**
+ * @param {number} jobId
+ * @returns {Promise<{job_id: number, status: string, stage: string, hosts_done: number, ports_found: number, eta_seconds: number|null, summary: string|null}>}
+ */
+export const getScanJob = async (jobId) => {
+  const response = await fetch(`${SCANNER_BACKEND_URL}/jobs/${jobId}`, {
+    method: "GET",
+    headers: {
+      Accept: "application/json",
+    },
+  })
+  return handleResponse(response)
+}
+
+/**
+ * Polls a scan job until it completes or fails.
+ * @param {number} jobId
+ * @param {{onProgress?: (job: object) => void, isCancelled?: () => boolean, intervalMs?: number}} options
+ * @returns {Promise<object>} - The finished job, or the last status seen if cancelled
+ */
+export const waitForScanJob = async (jobId, { onProgress, isCancelled, intervalMs = JOB_POLL_INTERVAL_MS } = {}) => {
+  while (true) {
+    const job = await getScanJob(jobId)
+    onProgress?.(job)
+    if (FINISHED_JOB_STATUSES.includes(job.status) || isCancelled?.()) {
+      return job
+    }
+    await new Promise((resolve) => setTimeout(resolve, intervalMs))
+  }
+}
+
+// Last dashboard seen, so an unchanged one is revalidated with a 304.
+let dashboardCache = null
+
+/**
+ * @returns {Promise<{run_id: number|null, scanned_at: string|null, latest_summary: string, host_count: number, open_ports: number, ports_per_host: Object<string, number>, top_services: Array<{service: string, count: number}>}>}
+ */
+export const getDashboard = async () => {
+  const headers = { Accept: "application/json" }
+  if (dashboardCache) headers["If-None-Match"] = dashboardCache.etag
+  const response = await fetch(`${SCANNER_BACKEND_URL}/dashboard`, { method: "GET", headers })
+  if (response.status === 304 && dashboardCache) {
+    return dashboardCache.data
+  }
+  const data = await handleResponse(response)
+  const etag = response.headers.get("ETag")
+  dashboardCache = etag ? { etag, data } : null
+  return data
+}
+
 /**
  * @returns {Promise<{latest_summary: string}>} - The latest summary object
  */